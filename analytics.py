@@ -0,0 +1,213 @@
+# incremental analytics state, kept next to each room's log
+#
+# each run folds only the entries appended since the saved state into it, and
+# gets the same decharged values, recharges, rollups and forecast as
+# processing the whole history again.
+
+import json
+import numpy as np
+from storage import csv_storage, storage_exception
+from records import history_dtype, as_history, read_records
+from rollup import rollup, merge_rollups, save_rollups, load_rollups
+from forecast import forecaster
+import metrics
+
+# bump when the saved state changes meaning, forcing a rebuild
+ANALYTICS_VERSION = 3
+analytics_sidecar = "analytics"
+# rollups a loaded state holds before its last entry, the recent days printed
+# and the bins later entries add to
+recent_rollups = np.timedelta64(7, "D")
+
+
+# seconds since epoch of datetime64 values, for fitting and interpolation
+def seconds(t: np.ndarray) -> np.ndarray:
+    return t.astype("datetime64[us]").astype(np.int64) / 1e6
+
+
+recharge_values = np.array([25, 50, 75, 100, 150, 200], dtype=np.float64)
+# amount recharged between history[index] and history[index + 1]
+recharge_dtype = np.dtype([("amount", "<f8"), ("index", "<i8")])
+
+
+# subtract recharges from remaining, letting values go negtive
+def decharge(history: np.ndarray, verbose: bool = True):
+    values = history["remain"]
+    steps = np.diff(values)
+    # any increase is a recharge, of the smallest recharge value greater than it
+    (indices,) = np.nonzero(steps > 0)
+    deltas = steps[indices]
+    value_idx = np.searchsorted(recharge_values, deltas, side="right")
+    amounts = np.where(
+        value_idx < len(recharge_values),
+        recharge_values[np.minimum(value_idx, len(recharge_values) - 1)],
+        deltas,  # more than the maximum value of 200 within sample interval
+    )
+    # todo: handle cases when the amount is less than a minimum of 25
+    recharges = np.empty(len(indices), dtype=recharge_dtype)
+    recharges["amount"] = amounts
+    recharges["index"] = indices
+
+    # history with recharged values removed, values can be below zero
+    recharged_steps = np.zeros(len(values))
+    recharged_steps[indices + 1] = amounts
+    decharged = history.copy()
+    decharged["remain"] = values - np.cumsum(recharged_steps)
+
+    if not verbose:
+        return decharged, recharges
+    query_times = history["query_time"]
+    for recharged, delta, idx in zip(amounts.tolist(), deltas.tolist(), indices):
+        before_time = query_times[idx].item()
+        after_time = query_times[idx + 1].item()
+        print(
+            f"recharged by {recharged}(delta:{delta}) between {before_time} and {after_time}"
+        )
+
+    return decharged, recharges
+
+
+class analytics_state(object):
+    rows: int  # history entries folded in so far
+    last: np.void  # the last of them, as stored
+    recharged_sum: float  # total recharges so far, subtracted from values
+    recharges: np.ndarray  # recharge_dtype, indices into the whole history
+    forecast: forecaster
+    rollups: dict[str, np.ndarray]
+    saved_last: np.datetime64 | None  # query time of the last entry saved
+
+    def __init__(self, history: np.ndarray):
+        history_decharged, self.recharges = decharge(history, verbose=False)
+        self.rows = len(history)
+        self.last = history[-1]
+        self.recharged_sum = float(self.recharges["amount"].sum())
+        self.forecast = forecaster()
+        self.forecast.feed(history_decharged)
+        self.rollups = rollup(history_decharged)
+        self.saved_last = None
+
+    # fold in a stretch of history starting with the last folded entry
+    def fold(self, stretch: np.ndarray):
+        stretch_decharged, stretch_recharges = decharge(stretch, verbose=False)
+        stretch_decharged["remain"] -= self.recharged_sum
+        stretch_recharges["index"] += self.rows - 1
+
+        self.rows += len(stretch) - 1
+        self.last = stretch[-1]
+        self.recharged_sum += float(stretch_recharges["amount"].sum())
+        self.recharges = np.concatenate([self.recharges, stretch_recharges])
+        self.forecast.feed(stretch_decharged[1:])
+        self.rollups = merge_rollups(self.rollups, rollup(stretch_decharged))
+
+    # the stretch of history after it, starting with its last folded entry
+    def stretch(self, history: np.ndarray) -> np.ndarray | None:
+        same = (
+            (history["remain"] == self.last["remain"])
+            & (history["query_time"] == self.last["query_time"])
+            & (history["request_time"] == self.last["request_time"])
+        )
+        (matches,) = np.nonzero(same)
+        return history[matches[0] :] if len(matches) else None
+
+    # arrays are kept as hex of their raw bytes, so they load back exactly
+    def dumps(self) -> bytes:
+        return json.dumps(
+            {
+                "version": ANALYTICS_VERSION,
+                "rows": self.rows,
+                "last": self.last.tobytes().hex(),
+                "recharged_sum": self.recharged_sum,
+                "recharges": self.recharges.tobytes().hex(),
+                "forecast": self.forecast.dumps(),
+            }
+        ).encode()
+
+    @classmethod
+    def loads(cls, content: bytes):
+        saved = json.loads(content)
+        if saved.get("version") != ANALYTICS_VERSION:
+            return None
+
+        def array(name: str, dtype: np.dtype) -> np.ndarray:
+            return np.frombuffer(bytes.fromhex(saved[name]), dtype=dtype).copy()
+
+        state = cls.__new__(cls)
+        state.rows = saved["rows"]
+        state.last = array("last", history_dtype)[0]
+        state.recharged_sum = saved["recharged_sum"]
+        state.recharges = array("recharges", recharge_dtype)
+        state.forecast = forecaster.loads(saved["forecast"])
+        state.saved_last = state.last["query_time"]
+        return state
+
+
+# with the recent rollups only, unless all_rollups
+def load_state(cs: csv_storage, all_rollups: bool = False) -> analytics_state | None:
+    content = cs.read_sidecar(analytics_sidecar)
+    if content is None:
+        return None
+    state = analytics_state.loads(content)
+    if state is None:
+        return None
+    since = None if all_rollups else state.saved_last - recent_rollups
+    state.rollups = load_rollups(cs, since)
+    return state if state.rollups is not None else None
+
+
+# rollups of the months before the last entry saved are as they were
+def save_state(cs: csv_storage, state: analytics_state):
+    cs.write_sidecar(analytics_sidecar, state.dumps())
+    save_rollups(cs, state.rollups, state.saved_last)
+    state.saved_last = state.last["query_time"]
+
+
+# a state of a whole history, folded a chunk at a time as records are read
+def build(cs: csv_storage) -> analytics_state | None:
+    state = None
+    for chunk in cs.iter_records():
+        if len(chunk) == 0:
+            continue
+        history = as_history(chunk)
+        if state is None:
+            state = analytics_state(history)
+        else:
+            state.fold(np.concatenate([state.last.reshape(1), history]))
+    return state
+
+
+# bring the saved state of a room up to date with its history, reading only
+# the records from its last folded entry on
+def update(cs: csv_storage) -> analytics_state:
+    with metrics.span("analytics"):
+        return _update(cs)
+
+
+def _update(cs: csv_storage) -> analytics_state:
+    state, changed = refresh(cs)
+    if changed:
+        save_state(cs, state)
+    return state
+
+
+# the saved state of a room brought up to date in memory only, and whether it
+# had to be
+def refresh(
+    cs: csv_storage, verbose: bool = True, all_rollups: bool = False
+) -> tuple[analytics_state, bool]:
+    state = load_state(cs, all_rollups)
+    stretch = None
+    if state is not None:
+        since = state.last["query_time"].item()
+        stretch = state.stretch(as_history(read_records(cs, since=since)))
+    if stretch is None:
+        # missing, outdated or not a prefix of this history any more
+        if verbose:
+            print("rebuilding analytics state")
+        state = build(cs)
+        if state is None:
+            raise storage_exception(f"{cs.filename} holds no records")
+    elif len(stretch) == 1:
+        return state, False
+    else:
+        state.fold(stretch)
+    return state, True
@@ -0,0 +1,304 @@
+# analytics of many rooms at once, on a grid of rooms × time
+#
+# recharges are taken out of the readings of every room in one pass over all
+# of them, then the readings are put on one time grid, interpolated between
+# the readings around each grid time the way rollup() does for one room.
+# consumption per period, percentiles across rooms and the ranking by time
+# left then each take one pass over the whole grid instead of a loop over
+# rooms. rooms come from a sweep store or from a list of room stores.
+
+import sys, warnings, datetime as dt
+import numpy as np
+from storage import csv_storage, storage_name, storage_exception
+from records import history_dtype, as_history, read_records
+from room_index import bad_query
+from analytics import recharge_values
+from rollup import periods
+from fetch import parse_options
+import sweep
+
+default_step = np.timedelta64(1, "h")
+default_days = 30
+default_top = 5
+# rate of use behind the ranking by time left, over the last day
+rate_window = np.timedelta64(1, "D")
+# rooms using more than the median by this many scaled MADs a day are outliers
+outlier_mads = 3.0
+percentiles = (10, 50, 90)
+
+
+# steps of the grid covering first..last, aligned like rollup periods, and
+# last itself so the readings of the step in progress count too
+def grid_times(first: np.datetime64, last: np.datetime64, step: np.timedelta64) -> np.ndarray:
+    step = step.astype("m8[us]")
+    origin = periods["hour"][1]
+    first_step = (first - origin) // step
+    last_step = (last - origin) // step
+    grid = origin + np.arange(first_step, last_step + 1) * step
+    return grid if grid[-1] == last else np.append(grid, last)
+
+
+# readings sorted by room, then by time
+def sort_readings(rooms: np.ndarray, times: np.ndarray, remains: np.ndarray):
+    # readings of a list of rooms come sorted already, those of sweeps do not
+    if np.all((rooms[1:] > rooms[:-1]) | ((rooms[1:] == rooms[:-1]) & (times[1:] >= times[:-1]))):
+        return rooms, times, remains
+    order = np.lexsort((times, rooms))
+    return rooms[order], times[order], remains[order]
+
+
+# recharges taken out of the sorted readings of every room, as
+# analytics.decharge does for one
+def decharge(rooms: np.ndarray, remains: np.ndarray) -> np.ndarray:
+    steps = np.diff(remains)
+    rising = (steps > 0) & (rooms[1:] == rooms[:-1])
+    value_idx = np.searchsorted(recharge_values, np.where(rising, steps, 0), side="right")
+    amounts = np.where(
+        value_idx < len(recharge_values),
+        recharge_values[np.minimum(value_idx, len(recharge_values) - 1)],
+        steps,
+    )
+    recharged = np.zeros(len(remains))
+    recharged[1:] = np.where(rising, amounts, 0.0)
+    total = np.cumsum(recharged)
+    # recharged before the first reading of each room's own
+    first = np.searchsorted(rooms, rooms, side="left")
+    return remains - (total - total[first])
+
+
+# values of each room at each grid time, interpolated between the readings
+# around it, NaN before a room's first reading and after its last. readings
+# are sorted flat columns, room is the row of each in the grid
+def align(
+    rooms: np.ndarray,
+    times: np.ndarray,
+    columns: list[np.ndarray],
+    n_rooms: int,
+    grid: np.ndarray,
+) -> list[np.ndarray]:
+    # one sorted key for every reading, each room after the one before it, so
+    # a single search finds the readings around every grid time of every room
+    us = np.timedelta64(1, "us")
+    t0 = min(times.min(), grid[0])
+    span = (max(times.max(), grid[-1]) - t0) // us + 1
+    keys = rooms.astype(np.int64) * span + (times - t0) // us
+    row = np.arange(n_rooms)[:, None]
+    grid_keys = row.astype(np.int64) * span + ((grid - t0) // us)[None, :]
+
+    before = np.searchsorted(keys, grid_keys, side="right") - 1
+    valid = before >= 0
+    before = np.maximum(before, 0)
+    valid &= rooms[before] == row
+    after = np.minimum(before + 1, len(keys) - 1)
+    # no reading after it, the grid time is that of the room's last reading
+    # or later, and only the former is within the room's readings
+    inside = (rooms[after] == row) & (after > before)
+    valid &= inside | (times[before] == grid[None, :])
+    gap = (times[after] - times[before]) / us
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weight = np.where(inside & (gap > 0), (grid[None, :] - times[before]) / us / gap, 0.0)
+    return [
+        np.where(valid, column[before] + weight * (column[after] - column[before]), np.nan)
+        for column in columns
+    ]
+
+
+# energy used by each room within each whole period of the grid
+def consumption(
+    grid: np.ndarray, decharged: np.ndarray, period: str
+) -> tuple[np.ndarray, np.ndarray]:
+    length, origin = periods[period]
+    on_edge = (grid - origin) % length.astype("m8[us]") == np.timedelta64(0, "us")
+    (edges,) = np.nonzero(on_edge)
+    used = -np.diff(decharged[:, edges], axis=1)
+    return grid[edges[:-1]], used
+
+
+# time left of each room at its own rate over the last rate_window, in
+# seconds, inf for rooms not using any and NaN without enough readings
+def time_left(grid: np.ndarray, values: np.ndarray, decharged: np.ndarray) -> np.ndarray:
+    rows = np.arange(len(values))
+    known = ~np.isnan(values)
+    # last column each room has a reading for
+    last = known.shape[1] - 1 - np.argmax(known[:, ::-1], axis=1)
+    back = np.searchsorted(grid, grid[last] - rate_window, side="left")
+    seconds = (grid[last] - grid[back]) / np.timedelta64(1, "s")
+    used = decharged[rows, back] - decharged[rows, last]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rate = np.where(seconds > 0, used / seconds, np.nan)
+        left = np.where(rate > 0, values[rows, last] / rate, np.inf)
+    return np.where(known.any(axis=1) & ~np.isnan(rate), left, np.nan)
+
+
+# rooms whose daily use is far above the median of all of them
+def outliers(daily: np.ndarray) -> np.ndarray:
+    known = daily[~np.isnan(daily)]
+    if len(known) == 0:
+        return np.zeros(len(daily), dtype=bool)
+    median = np.median(known)
+    mad = np.median(np.abs(known - median)) * 1.4826
+    with np.errstate(invalid="ignore"):
+        return daily > median + outlier_mads * max(mad, 1e-9)
+
+
+class batch(object):
+    keys: list[str]  # a name for each row of the grid
+    grid: np.ndarray  # grid times
+    values: np.ndarray  # rooms × time, remaining amount
+    decharged: np.ndarray  # rooms × time, recharges taken out
+
+    def __init__(
+        self,
+        keys: list[str],
+        rooms: np.ndarray,
+        times: np.ndarray,
+        remains: np.ndarray,
+        days: int = default_days,
+        step: np.timedelta64 = default_step,
+    ):
+        if len(times) == 0:
+            raise bad_query("no readings to analyse")
+        end = times.max()
+        self.keys = keys
+        self.grid = grid_times(end - np.timedelta64(days, "D"), end, step)
+        rooms, times, remains = sort_readings(rooms, times, remains)
+        decharged = decharge(rooms, remains)
+        self.values, self.decharged = align(
+            rooms, times, [remains, decharged], len(keys), self.grid
+        )
+
+    # per room, energy used each whole period and the percentiles across rooms
+    def per_period(self, period: str = "day") -> dict:
+        starts, used = consumption(self.grid, self.decharged, period)
+        with warnings.catch_warnings():
+            # periods no room was read in all through
+            warnings.simplefilter("ignore", RuntimeWarning)
+            spread = np.nanpercentile(used, percentiles, axis=0) if used.size else used
+        return {"start": starts, "used": used, "percentiles": spread}
+
+    # average energy used a day by each room, over the periods it was read in
+    def daily(self) -> np.ndarray:
+        used = self.per_period("day")["used"]
+        read = ~np.isnan(used)
+        with np.errstate(invalid="ignore"):
+            return np.where(read, used, 0.0).sum(axis=1) / read.sum(axis=1)
+
+    # rows of the rooms running out first, with their seconds left
+    def exhaustion_ranking(self) -> tuple[np.ndarray, np.ndarray]:
+        left = time_left(self.grid, self.values, self.decharged)
+        order = np.argsort(np.where(np.isnan(left), np.inf, left), kind="stable")
+        order = order[np.isfinite(left[order])]
+        return order, left[order]
+
+
+# readings of every room of a sweep store, with the room keys as names
+def from_sweep(selector: str, passphrase: str, days: int) -> batch:
+    store = sweep.sweep_store(selector, passphrase)
+    if store.magic() is None:
+        raise bad_query(f"no sweep of '{selector}' yet")
+    keys = sweep.read_rooms(store)
+    sweeps = sweep.read_sweeps(store)
+    return batch(keys, sweeps["room"], sweeps["query_time"], sweeps["remain"], days)
+
+
+# readings of a list of rooms, named by storage name since room names are secret
+def from_rooms(room_names: list[str], passphrase: str, days: int) -> batch:
+    since = dt.datetime.now() - dt.timedelta(days=days)
+    keys = [storage_name(name, passphrase) for name in room_names]
+    histories = [np.empty(0, dtype=history_dtype)]
+    rooms = [np.empty(0, dtype=np.int64)]
+    for row, key in enumerate(keys):
+        try:
+            cs = csv_storage.open_existing(key, passphrase)
+            history = as_history(read_records(cs, since=since))
+        except storage_exception:
+            # a room never saved stays a row without readings
+            continue
+        histories.append(history)
+        rooms.append(np.full(len(history), row))
+    history = np.concatenate(histories)
+    return batch(keys, np.concatenate(rooms), history["query_time"], history["remain"], days)
+
+
+def building_of(key: str) -> str:
+    # campus.partment of a room key, the rooms of a list make up one group
+    parts = key.split(".")
+    return ".".join(parts[:2]) if len(parts) == 4 else "rooms"
+
+
+def report(b: batch, top: int = default_top) -> str:
+    lines = []
+    daily = b.daily()
+    order, left = b.exhaustion_ranking()
+    flagged = outliers(daily)
+    days = b.per_period("day")
+    buildings: dict[str, list[int]] = {}
+    for row, key in enumerate(b.keys):
+        buildings.setdefault(building_of(key), []).append(row)
+
+    first, last = (str(t.astype("datetime64[m]")) for t in (b.grid[0], b.grid[-1]))
+    lines.append(f"{len(b.keys)} rooms, {first} to {last}")
+    for building, rows in buildings.items():
+        rows = np.array(rows)
+        read = rows[~np.isnan(b.values[rows]).all(axis=1)]
+        lines.append(f"{building}: {len(rows)} rooms, {len(read)} with readings")
+        # rooms read all through a day at least
+        read = read[~np.isnan(daily[read])]
+        if len(read) == 0:
+            continue
+        low, median, high = np.percentile(daily[read], percentiles)
+        total = np.nansum(days["used"][read])
+        lines.append(f"  used {total:.1f} kWh in whole days")
+        lines.append(
+            f"  a day per room: p{percentiles[0]} {low:.2f}, median {median:.2f}, p{percentiles[2]} {high:.2f} kWh"
+        )
+        most = read[np.argsort(-daily[read], kind="stable")[:top]]
+        lines.append("  most used: " + ", ".join(f"{b.keys[r]} {daily[r]:.2f}" for r in most))
+        in_building = set(read.tolist())
+        first_out = [(r, s) for r, s in zip(order, left) if r in in_building][:top]
+        if first_out:
+            lines.append(
+                "  running out first: "
+                + ", ".join(f"{b.keys[r]} in {s / 3600:.0f}h" for r, s in first_out)
+            )
+        flagged_rows = read[flagged[read]]
+        if len(flagged_rows):
+            lines.append(
+                "  outliers: " + ", ".join(f"{b.keys[r]} {daily[r]:.2f}" for r in flagged_rows)
+            )
+    return "\n".join(lines)
+
+
+def show_help_exit():
+    print("usage: batch_analytics.py [--days=N] [--top=N] <query_str>[,query_str2,...] <passphrase>")
+    print("       batch_analytics.py --sweep [--days=N] [--top=N] <selector> <passphrase>")
+    print(f"  --days=N   days of readings up to the latest, default {default_days}")
+    print(f"  --top=N    rooms listed in each ranking, default {default_top}")
+    print("  --sweep    rooms of the sweep store of a selector, see query.py --sweep")
+    exit(1)
+
+
+# main logic
+
+if __name__ == "__main__":
+    args, options = parse_options(sys.argv[1:])
+    if len(args) != 2 or not set(options) <= {"days", "top", "sweep"}:
+        print("invalid arguments.")
+        show_help_exit()
+    days = options.get("days", str(default_days))
+    top = options.get("top", str(default_top))
+    if not days.isdigit() or int(days) < 1 or not top.isdigit():
+        print("invalid days or top")
+        show_help_exit()
+
+    try:
+        if "sweep" in options:
+            b = from_sweep(args[0], args[1], int(days))
+        else:
+            # room names follow the @ of each query string, as for query.py
+            room_names = [qs.split("@")[-1] for qs in args[0].split(",")]
+            b = from_rooms(room_names, args[1], int(days))
+    except bad_query as e:
+        print(f"bad query: {e}")
+        exit(1)
+    print(report(b, int(top)))
@@ -0,0 +1,98 @@
+# cold start benchmark: import time of each entry point, as -X importtime reports it
+#
+# results are written as json, and compared against the results of an earlier
+# commit when given one, failing if any entry point got slower than tolerated.
+
+import os, sys, json, time, subprocess
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+from fetch import parse_options
+
+# name -> python arguments, run from the repository root
+targets = {
+    # rejects its arguments and exits, the path every run starts with
+    "query.py": ["query.py"],
+    "import room_index": ["-c", "import room_index"],
+    "import fetch": ["-c", "import fetch"],
+    "import storage": ["-c", "import storage"],
+    "import records": ["-c", "import records"],
+    "import analytics": ["-c", "import analytics"],
+    "import plot": ["-c", "import plot"],
+}
+
+default_runs = 5
+default_tolerance = 0.2
+
+
+# total microseconds spent importing, the cumulative time of top-level imports
+def import_time(stderr: str) -> int:
+    total = 0
+    for line in stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and not name.startswith("   "):
+            total += int(cumulative)
+    return total
+
+
+def measure(args: list[str], runs: int) -> dict:
+    import_us, wall_ms = [], []
+    for _ in range(runs):
+        begin = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", *args],
+            cwd=root,
+            capture_output=True,
+            text=True,
+        )
+        wall_ms.append((time.perf_counter() - begin) * 1e3)
+        import_us.append(import_time(result.stderr))
+    # the fastest run is the least disturbed by everything else on the machine
+    return {"import_us": min(import_us), "wall_ms": round(min(wall_ms), 3)}
+
+
+def show_help_exit():
+    print(
+        "usage: importtime.py [--runs=N] [--output=file.json] [--baseline=file.json] [--tolerance=0.2]"
+    )
+    exit(1)
+
+
+# main logic
+
+if __name__ == "__main__":
+    args, options = parse_options(sys.argv[1:])
+    if args or not set(options) <= {"runs", "output", "baseline", "tolerance"}:
+        print("invalid arguments.")
+        show_help_exit()
+    runs = int(options.get("runs", default_runs))
+    tolerance = float(options.get("tolerance", default_tolerance))
+
+    results = {}
+    for name, target_args in targets.items():
+        results[name] = measure(target_args, runs)
+        result = results[name]
+        print(
+            f"{name}: {result['import_us'] / 1e3:.1f} ms importing, {result['wall_ms']:.1f} ms total"
+        )
+
+    if "output" in options:
+        with open(options["output"], "wt", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+
+    if "baseline" in options:
+        with open(options["baseline"], "rt", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, result in results.items():
+            if name not in baseline:
+                continue
+            ratio = result["import_us"] / max(baseline[name]["import_us"], 1)
+            print(f"{name}: {ratio:.2f}x of baseline")
+            if ratio > 1 + tolerance:
+                regressions.append(name)
+        if regressions:
+            print(f"import time regressed: {regressions}")
+            exit(1)
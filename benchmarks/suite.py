@@ -0,0 +1,221 @@
+# benchmarks of storage and analytics over synthetic long-horizon histories
+#
+# histories are 10-minute samples over one to a few years, with a daily usage
+# pattern and recharges from recharge_values whenever a room runs low. every
+# stage of a run is timed on them, and the results are written as json so two
+# commits can be compared.
+
+import os, sys, io, json, time, shutil, tempfile, platform, subprocess, contextlib
+import datetime as dt
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+import numpy as np
+from fetch import parse_options
+from storage import csv_storage
+from records import record_dtype, append_records, append_record, read_records, manifest_sidecar
+from analytics import recharge_values
+import plot, analytics
+
+sample_interval = np.timedelta64(10, "m")
+week = dt.timedelta(days=7)
+passphrase = "benchmark"
+
+default_years = "1,3"
+default_rooms = "1,50"
+default_runs = 3
+default_output = "bench_output.json"
+
+
+# a room's history of 10-minute samples, as stored records
+def synthetic_history(years: float, rng: np.random.Generator) -> np.ndarray:
+    count = int(years * 365 * 24 * 6)
+    start = np.datetime64("2023-09-01T00:00", "us")
+    query_times = start + np.arange(count) * sample_interval.astype("m8[us]")
+    # meter readings land a little after the sample time
+    query_times += rng.integers(0, 60_000_000, count).astype("m8[us]")
+
+    # kWh per sample, higher in the evening, with some noise
+    hours = (query_times.astype("M8[h]").astype(np.int64) % 24).astype(np.float64)
+    base = rng.uniform(0.5, 2.0) / 6  # kW per room over 10 minutes
+    usage = base * (1 + 0.8 * np.sin((hours - 14) / 24 * 2 * np.pi))
+    usage *= rng.uniform(0.5, 1.5, count)
+
+    remain = np.empty(count)
+    value = rng.uniform(20, 100)
+    low = rng.uniform(2, 10)
+    for i in range(count):
+        value -= usage[i]
+        if value < low:
+            value += rng.choice(recharge_values)
+        remain[i] = round(value, 2)
+
+    records = np.empty(count, dtype=record_dtype)
+    records["remain"] = remain
+    records["query_time"] = query_times.astype(np.int64)
+    records["request_time"] = records["query_time"] + 5_000_000
+    return records
+
+
+def make_room(name: str, records: np.ndarray) -> csv_storage:
+    cs = csv_storage(name, passphrase)
+    append_records(cs, records)
+    return cs
+
+
+# appends the next 10-minute sample after the last record of a room
+def sample_appender(cs: csv_storage, records: np.ndarray):
+    last = records[-1]
+    state = {"time": int(last["query_time"]), "remain": float(last["remain"])}
+
+    def append():
+        state["time"] += int(sample_interval.astype("m8[us]").astype(np.int64))
+        state["remain"] -= 0.1
+        t = np.datetime64(state["time"], "us").item()
+        append_record(cs, state["remain"], t, t)
+
+    return append
+
+
+# every sidecar derived from the records, down to the rollups of each month
+# and the downsampled sealed partitions. the manifest is part of the records
+def clear_derived(cs: csv_storage):
+    kept = {cs.filename, cs.sidecar_filename(manifest_sidecar)}
+    for name in os.listdir(cs.filepath):
+        filename = f"{cs.filepath}/{name}"
+        if name.endswith(".enc") and filename not in kept:
+            os.remove(filename)
+
+
+def timed(fn, runs: int, setup=None) -> dict:
+    durations = []
+    for _ in range(runs):
+        if setup is not None:
+            setup()
+        # stages print as they go, which is not what is measured
+        with contextlib.redirect_stdout(io.StringIO()):
+            begin = time.perf_counter()
+            fn()
+            durations.append((time.perf_counter() - begin) * 1e3)
+    return {
+        "median_ms": round(float(np.median(durations)), 3),
+        "min_ms": round(min(durations), 3),
+        "runs": runs,
+    }
+
+
+# every stage of one room with a history of a number of years
+def bench_stages(years: float, runs: int, rng: np.random.Generator) -> dict:
+    records = synthetic_history(years, rng)
+    cs = make_room(f"stages-{years}", records)
+    history = plot.read_csv(cs)
+    decharged, _ = plot.decharge(history, verbose=False)
+    state = analytics.analytics_state(history)
+    with contextlib.redirect_stdout(io.StringIO()):
+        exhaustion = plot.estimate_exhaustion(state.forecast, state.last)
+
+    results = {
+        "rows": len(records),
+        "append": timed(sample_appender(cs, records), runs),
+        "read": timed(lambda: read_records(cs), runs),
+        "read_week": timed(
+            lambda: read_records(cs, since=history[-1]["query_time"].item() - week), runs
+        ),
+        "read_csv": timed(lambda: plot.read_csv(cs), runs),
+        "filter_recent": timed(lambda: plot.filter_recent(history), runs),
+        "decharge": timed(lambda: plot.decharge(history, verbose=False), runs),
+        "get_cost": timed(lambda: plot.get_cost(decharged), runs),
+        "analytics_rebuild": timed(lambda: analytics.analytics_state(history), runs),
+        "analytics_build": timed(lambda: analytics.build(cs), runs),
+        "estimate_exhaustion": timed(
+            lambda: plot.estimate_exhaustion(state.forecast, state.last), runs
+        ),
+    }
+    if exhaustion is not None:
+        ax = plot.chart_axes("recent", "", "")
+        results["plot_exhaustion"] = timed(
+            lambda: plot.plot_exhaustion(ax, exhaustion), runs
+        )
+    # cold: derived state rebuilt and charts rendered, warm: nothing new
+    results["plot_cold"] = timed(lambda: plot.plot(cs), runs, lambda: clear_derived(cs))
+    results["plot_warm"] = timed(lambda: plot.plot(cs), runs)
+    return results
+
+
+# one run's storage and analytics over many rooms, after their fetch
+def bench_rooms(rooms: int, years: float, runs: int, rng: np.random.Generator) -> dict:
+    rooms_cs = []
+    for i in range(rooms):
+        records = synthetic_history(years, rng)
+        cs = make_room(f"room-{rooms}-{i}", records)
+        rooms_cs.append((cs, sample_appender(cs, records)))
+
+    def run():
+        for cs, append in rooms_cs:
+            append()
+            plot.plot(cs)
+
+    return {"rooms": rooms, "years": years, "run": timed(run, runs)}
+
+
+def git_commit() -> str | None:
+    result = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=root, capture_output=True, text=True
+    )
+    return result.stdout.strip() or None
+
+
+def show_help_exit():
+    print(
+        "usage: suite.py [--years=1,3] [--rooms=1,50] [--room-years=1] [--runs=N] [--seed=N] [--output=file.json]"
+    )
+    print("  --years       history lengths the stages are timed on")
+    print("  --rooms       room counts a whole run is timed on")
+    print("  --room-years  history length of each of those rooms")
+    exit(1)
+
+
+# main logic
+
+if __name__ == "__main__":
+    args, options = parse_options(sys.argv[1:])
+    known = {"years", "rooms", "room-years", "runs", "seed", "output"}
+    if args or not set(options) <= known:
+        print("invalid arguments.")
+        show_help_exit()
+    years_list = [float(y) for y in options.get("years", default_years).split(",")]
+    rooms_list = [int(r) for r in options.get("rooms", default_rooms).split(",")]
+    room_years = float(options.get("room-years", 1))
+    runs = int(options.get("runs", default_runs))
+    rng = np.random.default_rng(int(options.get("seed", 0)))
+    output = os.path.abspath(options.get("output", default_output))
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "date": dt.datetime.now().isoformat(),
+        "stages": {},
+        "rooms": {},
+    }
+    # storage writes under ./logs, keep it away from real logs
+    workdir = tempfile.mkdtemp(prefix="dormitricity-bench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    os.mkdir("logs")
+    try:
+        for years in years_list:
+            print(f"stages, {years} years ...", end="", flush=True)
+            results["stages"][f"{years}y"] = bench_stages(years, runs, rng)
+            print(f" done")
+        for rooms in rooms_list:
+            print(f"{rooms} rooms, {room_years} years each ...", end="", flush=True)
+            results["rooms"][f"{rooms}"] = bench_rooms(rooms, room_years, runs, rng)
+            print(f" done")
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir)
+
+    with open(output, "wt", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f"results written to {output}")
@@ -0,0 +1,145 @@
+# daemon mode: one process polling every room for as long as it runs
+#
+# the session, the room index and the derived keys stay warm from one poll to
+# the next, instead of being set up again by a process per sample. each room
+# has a schedule of its own: it is polled again after a fraction of the time
+# left until it runs out, so rooms close to running out are polled often and
+# idle ones rarely, within min_interval and max_interval.
+
+import asyncio, signal, datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from fetch import default_min_interval, default_max_interval
+import fetch, metrics
+
+# polls in the time left before a room runs out
+polls_per_exhaustion = 24
+
+
+# seconds until a room is polled again, from its analytics state
+def next_interval(state, min_interval: float, max_interval: float) -> float:
+    if state is None or state.forecast.samples == 0:
+        # no rate to go by yet
+        return min_interval
+    remain = float(state.last["remain"])
+    exhaustion = state.forecast.exhaustion(remain)
+    if exhaustion is None:
+        # not using any electricity
+        return max_interval
+    _, earliest, _ = exhaustion
+    # counted from the last reading, which may be a while ago
+    since_last = (dt.datetime.now() - state.last["query_time"].item()).total_seconds()
+    interval = (earliest - since_last) / polls_per_exhaustion
+    return min(max(interval, min_interval), max_interval)
+
+
+class scheduler(object):
+    def __init__(
+        self,
+        rooms: list[tuple[str, dict]],
+        passphrase: str,
+        transport,
+        save,
+        concurrency: int = fetch.default_concurrency,
+        min_interval: float = default_min_interval,
+        max_interval: float = default_max_interval,
+    ):
+        self.rooms = rooms
+        self.passphrase = passphrase
+        self.save = save  # (room_name, data) -> analytics state, None if skipped
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        # one fetcher for the whole run, its breaker and limiter see every room
+        self.fetcher = fetch.fetcher(transport, concurrency)
+        self.fetch_pool = ThreadPoolExecutor(max_workers=concurrency)
+        # saving renders charts, one room at a time
+        self.save_pool = ThreadPoolExecutor(max_workers=1)
+        self.states: dict[str, object] = {}
+        self.failures: dict[str, int] = {}  # saves failed in a row
+        # imported here, storage is only loaded once polling starts
+        from storage import storage_name
+
+        # room names are secret, logs of the run are not
+        self.names = {name: storage_name(name, passphrase) for name, _ in rooms}
+
+    # state of a room whose reading was not new, from its saved analytics
+    def saved_state(self, room_name: str):
+        # imported here, like query.save_result
+        from storage import csv_storage
+        import analytics
+
+        return analytics.load_state(csv_storage(room_name, self.passphrase))
+
+    # poll a room once, returns the seconds until the next poll
+    async def poll(self, room_name: str, search_data: dict) -> float:
+        loop = asyncio.get_running_loop()
+        name = self.names[room_name]
+        with metrics.span("fetch"):
+            status = await loop.run_in_executor(
+                self.fetch_pool, self.fetcher.status, search_data
+            )
+        if status["data"] is None:
+            print(f"{name}: failed, {status['error']}")
+            return self.min_interval
+
+        try:
+            state = await loop.run_in_executor(
+                self.save_pool, self.save, room_name, status["data"]
+            )
+            if state is None:
+                state = self.states.get(room_name)
+            if state is None:
+                state = await loop.run_in_executor(
+                    self.save_pool, self.saved_state, room_name
+                )
+        except Exception as e:
+            # a room that cannot be saved leaves the others polling, and is
+            # tried less often while it keeps failing
+            failures = self.failures.get(room_name, 0) + 1
+            self.failures[room_name] = failures
+            interval = min(self.min_interval * 2 ** (failures - 1), self.max_interval)
+            print(f"{name}: save failed, {type(e).__name__}: {e}, next poll in {interval / 60:.0f} min")
+            return interval
+        self.failures.pop(room_name, None)
+        self.states[room_name] = state
+        interval = next_interval(state, self.min_interval, self.max_interval)
+        print(f"{name}: next poll in {interval / 60:.0f} min")
+        return interval
+
+    async def room(self, room_name: str, search_data: dict):
+        while True:
+            interval = await self.poll(room_name, search_data)
+            await asyncio.sleep(interval)
+
+    async def run(self):
+        rooms = asyncio.gather(
+            *(self.room(room_name, search_data) for room_name, search_data in self.rooms)
+        )
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, rooms.cancel)
+        try:
+            await rooms
+        except asyncio.CancelledError:
+            print("stopping")
+        finally:
+            # a room being saved is saved to the end
+            self.fetch_pool.shutdown(cancel_futures=True)
+            self.save_pool.shutdown()
+
+
+# poll rooms until interrupted or terminated
+def run(
+    rooms: list[tuple[str, dict]],
+    passphrase: str,
+    transport,
+    save,
+    concurrency: int = fetch.default_concurrency,
+    min_interval: float = default_min_interval,
+    max_interval: float = default_max_interval,
+):
+    print(f"polling {len(rooms)} rooms, every {min_interval / 60:.0f} to {max_interval / 60:.0f} min")
+    s = scheduler(
+        rooms, passphrase, transport, save, concurrency, min_interval, max_interval
+    )
+    asyncio.run(s.run())
+    print("stopped")
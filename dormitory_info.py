@@ -1,84 +1,297 @@
 # fetch dormitory info as json
 
-import requests, json, datetime as dt
-from config import cookies, json_or_exit
+import json, os, sys, threading, time, datetime as dt
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs
+from fetch import parse_options, fetcher, fetch_exception
+import transport
+from room_index import build_index
 
+info_filename = "dormitory_info.json"
+checkpoint_filename = "dormitory_info.checkpoint.json"
+diff_filename = "dormitory_info.diff.json"
 
-def fetch_dormitories(aria_id: str, part_id: str, floor_id: str):
-    responce = requests.post(
-        "https://app.bupt.edu.cn/buptdf/wap/default/drom",  # should be dorm though
-        data={"areaid": aria_id, "partmentId": part_id, "floorId": floor_id},
-        cookies=cookies,
-    )
-    res_json = json_or_exit(responce)
-    # return list of dormitory names
-    dorm_dict = dict()
-    for dorm in res_json["d"]["data"]:
-        name = dorm["dromName"]
-        id = dorm["dromNum"]
-        dorm_dict[name] = id
-    return dorm_dict
-
-
-def fetch_floors(aria_id: str, part_id: str):
-    responce = requests.post(
-        "https://app.bupt.edu.cn/buptdf/wap/default/floor",
-        data={"areaid": aria_id, "partmentId": part_id},
-        cookies=cookies,
-    )
-    res_json = json_or_exit(responce)
-    floors = [x["floorName"] for x in res_json["d"]["data"]]
-    floor_dict = dict()
-    room_counter = 0
-    for floor in floors:
-        dorm_dict = fetch_dormitories(aria_id, part_id, floor)
-        floor_dict[floor] = dorm_dict
-        room_counter += len(dorm_dict)
-        print(f"{len(dorm_dict)}, {room_counter}\r", end="", flush=True)
-    return floor_dict, room_counter
-
-
-def fetch_campus(area_id: str):
-    responce = requests.post(
-        "https://app.bupt.edu.cn/buptdf/wap/default/part",
-        data={
-            "areaid": area_id,
-        },
-        cookies=cookies,
-    )
+campus_list = [("1", "西土城"), ("2", "沙河")]
+
+default_workers = 8
+default_rate = 20.0  # requests per second over all workers
+checkpoint_interval = 5.0  # seconds between checkpoint writes
+
+
+# spaces requests out so all workers together stay below a rate
+class rate_limiter(object):
+    interval: float
+    next_time: float
+
+    def __init__(self, rate: float):
+        self.interval = 1.0 / rate
+        self.next_time = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            wait_time = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+
+# everything fetched so far, saved to disk so an interrupted crawl can resume
+#   parts:  area_id -> [[partmentId, partmentName], ...]
+#   floors: "area_id/partmentId" -> [floorName, ...]
+#   dorms:  "area_id/partmentId/floorName" -> {dromName: dromNum}
+class checkpoint(object):
+    parts: dict[str, list[list[str]]]
+    floors: dict[str, list[str]]
+    dorms: dict[str, dict[str, str]]
+
+    def __init__(self, resume: bool):
+        self.parts, self.floors, self.dorms = {}, {}, {}
+        self.lock = threading.Lock()
+        self.saved_time = time.monotonic()
+        if resume and os.path.exists(checkpoint_filename):
+            with open(checkpoint_filename, "rt", encoding="utf-8") as f:
+                saved = json.load(f)
+            self.parts, self.floors, self.dorms = (
+                saved["parts"],
+                saved["floors"],
+                saved["dorms"],
+            )
+            print(f"resuming with {len(self.dorms)} floors fetched")
+
+    def save(self, force: bool = False):
+        with self.lock:
+            if not force and time.monotonic() - self.saved_time < checkpoint_interval:
+                return
+            content = json.dumps(
+                {"parts": self.parts, "floors": self.floors, "dorms": self.dorms}
+            )
+            self.saved_time = time.monotonic()
+        tmp_filename = f"{checkpoint_filename}.tmp"
+        with open(tmp_filename, "wt", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(tmp_filename, checkpoint_filename)
+
+    def remove(self):
+        if os.path.exists(checkpoint_filename):
+            os.remove(checkpoint_filename)
+
+
+class crawler(object):
+    def __init__(self, t, workers: int, rate: float, cp: checkpoint):
+        self.fetcher = fetcher(t, workers)
+        self.workers = workers
+        self.limiter = rate_limiter(rate)
+        self.checkpoint = cp
+        self.room_counter = 0
+
+    # retried like the rooms of query.py, a crawl stops once one keeps failing
+    def post(self, endpoint: str, data: dict) -> list:
+        self.limiter.wait()
+        res, _ = self.fetcher.post(lambda t: t.post(endpoint, data))
+        return res["d"]["data"]
+
+    def fetch_parts(self, area_id: str):
+        if area_id not in self.checkpoint.parts:
+            data = self.post("part", {"areaid": area_id})
+            self.checkpoint.parts[area_id] = [
+                [d["partmentId"], d["partmentName"]] for d in data
+            ]
+        return self.checkpoint.parts[area_id]
 
-    res_json = json_or_exit(responce)
-    data = res_json["d"]["data"]
-    campus_dict = dict()
-    room_counter = 0
-    for d in data:
-        partmentId = d["partmentId"]
-        partmentName = d["partmentName"]
-        floors, rooms = fetch_floors(area_id, partmentId)
-        room_counter += rooms
-        campus_dict[partmentName] = {"id": partmentId, "floors": floors}
-    # dormitory_dict[name] = campus_dict
-    return campus_dict, room_counter
-
-
-def fetch_bupt():
-    campus_list = [("1", "西土城"), ("2", "沙河")]
+    def fetch_floors(self, area_id: str, part_id: str, refresh: bool = False):
+        key = f"{area_id}/{part_id}"
+        if refresh or key not in self.checkpoint.floors:
+            data = self.post("floor", {"areaid": area_id, "partmentId": part_id})
+            self.checkpoint.floors[key] = [x["floorName"] for x in data]
+        return self.checkpoint.floors[key]
+
+    def fetch_dormitories(self, area_id: str, part_id: str, floor_id: str):
+        key = f"{area_id}/{part_id}/{floor_id}"
+        if key not in self.checkpoint.dorms:
+            data = self.post(
+                "drom",  # should be dorm though
+                {"areaid": area_id, "partmentId": part_id, "floorId": floor_id},
+            )
+            # dict of dormitory names to ids
+            dorm_dict = {d["dromName"]: d["dromNum"] for d in data}
+            with self.checkpoint.lock:
+                self.checkpoint.dorms[key] = dorm_dict
+            self.checkpoint.save()
+        dorm_dict = self.checkpoint.dorms[key]
+        with self.checkpoint.lock:
+            self.room_counter += len(dorm_dict)
+            print(f"{len(dorm_dict)}, {self.room_counter}\r", end="", flush=True)
+        return dorm_dict
+
+    # fetch the floor lists of every building in parallel
+    def crawl_floors(self, refresh: bool = False):
+        parts = [
+            (area_id, part_id, part_name)
+            for area_id, _ in campus_list
+            for part_id, part_name in self.fetch_parts(area_id)
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(lambda p: self.fetch_floors(p[0], p[1], refresh), parts))
+        return parts
+
+    # fetch the dormitories of every floor in parallel
+    def crawl_dormitories(self, parts: list[tuple[str, str, str]]):
+        floor_keys = [
+            (area_id, part_id, floor)
+            for area_id, part_id, _ in parts
+            for floor in self.checkpoint.floors[f"{area_id}/{part_id}"]
+        ]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            list(executor.map(lambda k: self.fetch_dormitories(*k), floor_keys))
+        print()
+
+
+def assemble(cp: checkpoint, parts: list[tuple[str, str, str]]):
     dormitory_info = dict()
     for area_id, name in campus_list:
-        campus_dict, rooms = fetch_campus(area_id)
+        campus_dict = dict()
+        rooms = 0
+        for part_area_id, part_id, part_name in parts:
+            if part_area_id != area_id:
+                continue
+            floors = {
+                floor: cp.dorms[f"{area_id}/{part_id}/{floor}"]
+                for floor in cp.floors[f"{area_id}/{part_id}"]
+            }
+            rooms += sum(map(len, floors.values()))
+            campus_dict[part_name] = {"id": part_id, "floors": floors}
         dormitory_info[name] = campus_dict
         dormitory_info[f"__{name}_rooms__"] = rooms
         print(f"{rooms} rooms in {name}")
     return dormitory_info
 
 
+# seed the checkpoint with buildings whose floor list did not change,
+# so only new or changed buildings are crawled again
+def seed_unchanged(cp: checkpoint, old_info: dict, parts: list[tuple[str, str, str]]):
+    unchanged = 0
+    for area_id, part_id, part_name in parts:
+        campus = dict(campus_list)[area_id]
+        old_part = old_info.get(campus, {}).get(part_name)
+        if old_part is None or old_part["id"] != part_id:
+            continue
+        if list(old_part["floors"]) != cp.floors[f"{area_id}/{part_id}"]:
+            continue
+        unchanged += 1
+        for floor, dorm_dict in old_part["floors"].items():
+            cp.dorms.setdefault(f"{area_id}/{part_id}/{floor}", dorm_dict)
+    print(f"{unchanged} of {len(parts)} buildings unchanged")
+
+
+# rooms added, removed or renumbered between two versions of dormitory_info
+def diff_info(old_info: dict, new_info: dict):
+    def flatten(info: dict):
+        rooms = dict()
+        for campus, campus_dict in info.items():
+            if campus.startswith("__"):
+                continue
+            for part_name, part in campus_dict.items():
+                for floor, dorm_dict in part["floors"].items():
+                    for dorm, dorm_id in dorm_dict.items():
+                        rooms[f"{campus}.{part_name}.{floor}.{dorm}"] = dorm_id
+        return rooms
+
+    old_rooms, new_rooms = flatten(old_info), flatten(new_info)
+    return {
+        "added": sorted(new_rooms.keys() - old_rooms.keys()),
+        "removed": sorted(old_rooms.keys() - new_rooms.keys()),
+        "changed": sorted(
+            room
+            for room in new_rooms.keys() & old_rooms.keys()
+            if new_rooms[room] != old_rooms[room]
+        ),
+    }
+
+
+def show_help_exit():
+    print(
+        "usage: dormitory_info.py [--resume] [--refresh] [--workers=N] [--rate=R] [--transport=live|record|replay] [--api-url=URL] [--timeout=S] [--recordings=DIR] <cookies>"
+    )
+    print("  --resume     continue an interrupted crawl from its checkpoint")
+    print(f"  --refresh    only re-crawl buildings whose floors differ from {info_filename}")
+    print(f"  --workers=N  parallel requests, default {default_workers}")
+    print(f"  --rate=R     requests per second at most, default {default_rate}")
+    print("  --transport  live (default), record responses, or replay recorded ones")
+    print("  --api-url    api to crawl, such as a local standin.py")
+    print("  --timeout=S  seconds each request may take")
+    print(f"  --recordings where responses are recorded, default {transport.default_recordings}")
+    exit(1)
+
+
 # main logic
 
-begin = dt.datetime.now()
+if __name__ == "__main__":
+    args, options = parse_options(sys.argv[1:])
+    if len(args) != 1 or not set(options) <= {
+        "resume",
+        "refresh",
+        "workers",
+        "rate",
+        "transport",
+        "api-url",
+        "timeout",
+        "recordings",
+    }:
+        print("invalid arguments.")
+        show_help_exit()
+    try:
+        workers = int(options.get("workers", default_workers))
+        rate = float(options.get("rate", default_rate))
+    except ValueError:
+        workers = rate = 0
+    if workers < 1 or rate <= 0:
+        print("invalid workers or rate")
+        show_help_exit()
+    if options.get("transport", "live") not in transport.transport_modes:
+        print("invalid transport")
+        show_help_exit()
+
+    cookies = {k: v[0] for k, v in parse_qs(args[0]).items()}
+
+    begin = dt.datetime.now()
+
+    cp = checkpoint("resume" in options)
+    t = transport.make_transport(options, cookies, workers)
+    c = crawler(t, workers, rate, cp)
+    try:
+        if "refresh" in options:
+            with open(info_filename, "rt", encoding="utf-8") as f:
+                old_info = json.load(f)
+            # floor lists are always fetched again to detect changes
+            parts = c.crawl_floors(refresh=True)
+            seed_unchanged(cp, old_info, parts)
+        else:
+            parts = c.crawl_floors()
+        c.crawl_dormitories(parts)
+    except fetch_exception as e:
+        print(f"crawl failed: {e}")
+        print("continue it later with --resume")
+        exit(1)
+    finally:
+        cp.save(force=True)
+
+    dormitory_info = assemble(cp, parts)
+    with open(info_filename, "wt", encoding="utf-8") as f:
+        json.dump(dormitory_info, f)
+    build_index(info_filename)
 
-with open("dormitory_info.json", "wt", encoding="utf-8") as f:
-    json.dump(fetch_bupt(), f)
+    if "refresh" in options:
+        diff = diff_info(old_info, dormitory_info)
+        with open(diff_filename, "wt", encoding="utf-8") as f:
+            json.dump(diff, f, ensure_ascii=False, indent=2)
+        print(
+            f"{len(diff['added'])} added, {len(diff['removed'])} removed, "
+            f"{len(diff['changed'])} changed, see {diff_filename}"
+        )
+    cp.remove()
 
-end = dt.datetime.now()
-duration = end - begin
-print(f"time: {duration}")
+    end = dt.datetime.now()
+    duration = end - begin
+    print(f"time: {duration}")
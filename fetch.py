@@ -0,0 +1,228 @@
+# fetch remaining electricity from the bupt api, many rooms at once
+#
+# a room that fails never takes the others down with it. each request has a
+# timeout and is retried with exponential backoff and jitter, a circuit breaker
+# stops sending requests while the api keeps failing, and the number of
+# requests in flight backs off when latency or errors climb.
+
+import time, random, threading
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+API_URL = "https://app.bupt.edu.cn/buptdf/wap/default"
+
+default_concurrency = 8
+default_timeout = 10.0  # seconds per request
+
+# retries
+max_attempts = 4
+backoff_base = 0.5  # seconds, doubled on every retry
+backoff_cap = 8.0
+
+# circuit breaker, opened after this many failures in a row
+breaker_threshold = 10
+breaker_cooldown = 30.0  # seconds before one request is let through again
+
+# adaptive concurrency, slower responses than this count as congestion
+latency_target = 2.0
+
+# polls of a room in daemon mode, see daemon.py, seconds apart
+default_min_interval = 10 * 60  # as often as the cron schedule
+default_max_interval = 6 * 3600
+
+
+# split "--name=value" options from positional arguments of a script
+def parse_options(argv: list[str]) -> tuple[list[str], dict[str, str]]:
+    args: list[str] = []
+    options: dict[str, str] = {}
+    for arg in argv:
+        if arg.startswith("--"):
+            name, _, value = arg[2:].partition("=")
+            options[name] = value
+        else:
+            args.append(arg)
+    return args, options
+
+
+class fetch_exception(Exception):
+    def __init__(self, message: str, retryable: bool = False):
+        super().__init__(message)
+        self.retryable = retryable
+
+
+def json_or_raise(res):
+    if res.status_code != 200:
+        # the api is overloaded or down, worth another try
+        raise fetch_exception(
+            f"http {res.status_code} from {res.url}",
+            retryable=res.status_code >= 500 or res.status_code == 429,
+        )
+    try:
+        return res.json()
+    except Exception as e:
+        # a login page instead of json, the cookies expired
+        raise fetch_exception(
+            f"error fetching json: {e}, url: {res.url}, responce: {res.content[:100]}"
+        )
+
+
+# one keep-alive connection pool shared by every request of the run
+def make_session(cookies: dict, concurrency: int = default_concurrency):
+    # imported here, scripts validate their arguments without paying for it
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.cookies.update(cookies)
+    return session
+
+
+# search form of the api for a room
+def search_form(campus: str, partment_id: str, floor: str, room_id: str) -> dict:
+    return {
+        "partmentId": partment_id,
+        "floorId": floor,
+        "dromNumber": room_id,
+        "areaid": str(int(campus != "西土城") + 1),
+    }
+
+
+# transport is one of transport.py, answering posts with parsed json
+def fetch_remain(transport, search_data: dict) -> dict:
+    res: dict = transport.post("search", search_data)
+    if res.get("e") not in (0, None) or not res.get("d", {}).get("data"):
+        raise fetch_exception(f"api error: {res.get('m', res)}")
+    return res["d"]["data"]
+
+
+# full jitter, anywhere up to the exponential backoff of an attempt
+def backoff(attempt: int) -> float:
+    return random.uniform(0, min(backoff_cap, backoff_base * 2**attempt))
+
+
+class circuit_breaker(object):
+    def __init__(self, threshold: int = breaker_threshold, cooldown: float = breaker_cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0  # in a row
+        self.last_error = ""
+        self.opened_time = None
+        self.lock = threading.Lock()
+
+    # raises while open, lets one request through once the cooldown passed
+    def check(self):
+        with self.lock:
+            if self.opened_time is None:
+                return
+            if time.monotonic() - self.opened_time < self.cooldown:
+                raise fetch_exception(
+                    f"circuit open after {self.failures} failures, last: {self.last_error}"
+                )
+            # half open, the next result closes or opens it again
+            self.opened_time = time.monotonic()
+
+    def record(self, error: fetch_exception | None):
+        with self.lock:
+            if error is None:
+                self.failures = 0
+                self.opened_time = None
+                return
+            self.failures += 1
+            self.last_error = str(error)
+            if self.failures >= self.threshold:
+                if self.opened_time is None:
+                    print(f"circuit opened after {self.failures} failures in a row")
+                self.opened_time = time.monotonic()
+
+
+# additive increase, multiplicative decrease of the requests in flight
+class concurrency_limiter(object):
+    def __init__(self, limit: int):
+        self.max_limit = limit
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    # congested when the request timed out, was refused or came back slowly
+    def release(self, congested: bool, latency: float):
+        with self.condition:
+            self.in_flight -= 1
+            if not congested and latency < latency_target:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            else:
+                self.limit = max(1.0, self.limit / 2)
+            self.condition.notify_all()
+
+
+class fetcher(object):
+    def __init__(self, transport, concurrency: int = default_concurrency):
+        self.transport = transport
+        self.concurrency = concurrency
+        self.breaker = circuit_breaker()
+        self.limiter = concurrency_limiter(concurrency)
+
+    # a post, retried while it fails in a way worth retrying
+    def post(self, fn, *args) -> tuple[object, int]:
+        for attempt in range(max_attempts):
+            self.breaker.check()
+            self.limiter.acquire()
+            begin = time.monotonic()
+            try:
+                with metrics.span("http"):
+                    result = fn(self.transport, *args)
+            except fetch_exception as e:
+                # expired cookies or a bad room say nothing about congestion
+                self.limiter.release(e.retryable, time.monotonic() - begin)
+                self.breaker.record(e)
+                if not e.retryable or attempt + 1 == max_attempts:
+                    raise
+                metrics.add("retries", 1)
+                time.sleep(backoff(attempt))
+                continue
+            self.limiter.release(False, time.monotonic() - begin)
+            self.breaker.record(None)
+            return result, attempt + 1
+
+    def status(self, search_data: dict) -> dict:
+        try:
+            data, attempts = self.post(fetch_remain, search_data)
+        except fetch_exception as e:
+            return {"data": None, "error": str(e)}
+        return {"data": data, "attempts": attempts}
+
+    # every room in parallel, statuses keep the order of search_datas
+    def fetch_all(self, search_datas: list[dict]) -> list[dict]:
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            return list(executor.map(self.status, search_datas))
+
+
+# status of each room, {"data": ...} if fetched and {"error": ...} if not
+def fetch_all(
+    transport,
+    search_datas: list[dict],
+    concurrency: int = default_concurrency,
+) -> list[dict]:
+    return fetcher(transport, concurrency).fetch_all(search_datas)
+
+
+# a line for each room, or only for those that did not go smoothly
+def print_summary(names: list[str], statuses: list[dict], every_room: bool = True):
+    failed = 0
+    for name, status in zip(names, statuses):
+        if status["data"] is None:
+            failed += 1
+            print(f"  {name}: failed, {status['error']}")
+        elif status["attempts"] > 1:
+            print(f"  {name}: ok after {status['attempts']} attempts")
+        elif every_room:
+            print(f"  {name}: ok")
+    print(f"{len(names) - failed} of {len(names)} rooms fetched and saved")
@@ -0,0 +1,108 @@
+# streaming forecast of when a room runs out of electricity
+#
+# consumption rates are averaged over several horizons with exponential
+# weights in time, along with how much they vary, so each new entry updates
+# the forecast in constant time and no history has to be fitted again.
+
+import math
+import numpy as np
+
+# time constants of the averaged rates, in seconds
+horizons = {
+    "6h": 6 * 3600.0,
+    "1d": 86400.0,
+    "7d": 7 * 86400.0,
+}
+# the rate exhaustion is estimated from
+default_horizon = "1d"
+# width of the confidence band, in standard errors of the rate
+band_z = 2.0
+# weight of each new interval in the average interval between entries
+interval_alpha = 0.1
+
+
+class forecaster(object):
+    time: float | None  # seconds since epoch of the last entry
+    value: float  # its decharged remaining amount
+    samples: int  # rates averaged so far
+    interval: float  # average seconds between entries
+    rates: dict[str, list[float]]  # horizon -> [mean, variance], kWh per second
+
+    def __init__(self):
+        self.time = None
+        self.value = 0.0
+        self.samples = 0
+        self.interval = 0.0
+        self.rates = {name: [0.0, 0.0] for name in horizons}
+
+    # fold in the next decharged entry
+    def update(self, time: float, value: float):
+        if self.time is None:
+            self.time, self.value = time, value
+            return
+        dt = time - self.time
+        if dt <= 0:
+            # a reading repeated or out of order, nothing to learn a rate from
+            self.value = value
+            return
+        rate = (self.value - value) / dt
+        for name, tau in horizons.items():
+            mean_var = self.rates[name]
+            if self.samples == 0:
+                mean_var[:] = [rate, 0.0]
+                continue
+            alpha = 1.0 - math.exp(-dt / tau)
+            diff = rate - mean_var[0]
+            mean_var[0] += alpha * diff
+            mean_var[1] = (1.0 - alpha) * (mean_var[1] + alpha * diff * diff)
+        if self.samples == 0:
+            self.interval = dt
+        else:
+            self.interval += interval_alpha * (dt - self.interval)
+        self.samples += 1
+        self.time, self.value = time, value
+
+    def feed(self, history_decharged: np.ndarray):
+        times = history_decharged["query_time"].astype("datetime64[us]").astype(np.int64)
+        for time, value in zip((times / 1e6).tolist(), history_decharged["remain"].tolist()):
+            self.update(time, value)
+
+    # mean rate of a horizon and its standard error, in kWh per second
+    def rate(self, horizon: str = default_horizon) -> tuple[float, float]:
+        mean, var = self.rates[horizon]
+        # entries the horizon effectively averages over
+        n = min(self.samples, horizons[horizon] / self.interval) if self.interval else 1
+        return mean, math.sqrt(var / max(n, 1.0))
+
+    # seconds after the last entry until remain is used up, as the estimate
+    # and the earliest and latest within the band, None when not running out
+    def exhaustion(
+        self, remain: float, horizon: str = default_horizon
+    ) -> tuple[float, float, float] | None:
+        if self.samples == 0:
+            return None
+        mean, stderr = self.rate(horizon)
+        if mean <= 0:
+            return None
+        high, low = mean + band_z * stderr, mean - band_z * stderr
+        latest = remain / low if low > 0 else math.inf
+        return remain / mean, remain / high, latest
+
+    def dumps(self) -> dict:
+        return {
+            "time": self.time,
+            "value": self.value,
+            "samples": self.samples,
+            "interval": self.interval,
+            "rates": self.rates,
+        }
+
+    @classmethod
+    def loads(cls, saved: dict):
+        fc = cls()
+        fc.time = saved["time"]
+        fc.value = saved["value"]
+        fc.samples = saved["samples"]
+        fc.interval = saved["interval"]
+        fc.rates.update(saved["rates"])
+        return fc
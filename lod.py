@@ -0,0 +1,123 @@
+# level of detail for charts over long ranges of history
+#
+# history is split into buckets of a width from ladder, chosen so a range has
+# at most max_buckets of them, and only the first, lowest, highest and last
+# entry of each bucket are kept. buckets never span a recharge, so the entries
+# on both sides of every recharge are kept exactly. charts then draw about the
+# same number of points whatever the length of the range.
+
+import datetime as dt
+import numpy as np
+
+# bucket widths, from the finest
+ladder = [
+    np.timedelta64(10, "m"),
+    np.timedelta64(1, "h"),
+    np.timedelta64(6, "h"),
+    np.timedelta64(1, "D"),
+    np.timedelta64(7, "D"),
+]
+max_buckets = 1000
+# sealed partitions are kept downsampled at this width, ranges drawn in wider
+# buckets are drawn from those instead of every record
+cached_width = ladder[2]
+origin = np.datetime64("1970-01-05", "us")  # a monday, weeks start on it
+
+
+# the finest width splitting a span into at most max_buckets
+def bucket_width(span: np.timedelta64) -> np.timedelta64:
+    for width in ladder:
+        if span // width.astype("m8[us]") <= max_buckets:
+            return width.astype("m8[us]")
+    return ladder[-1].astype("m8[us]")
+
+
+def floor_time(t: np.datetime64, width: np.timedelta64) -> np.datetime64:
+    return origin + (t - origin) // width * width
+
+
+# bucket width of the last span of history, all of it when span is None
+def window_width(times: np.ndarray, span: dt.timedelta | None) -> np.timedelta64:
+    if span is None:
+        return bucket_width(times[-1] - times[0])
+    return bucket_width(np.timedelta64(span).astype("m8[us]"))
+
+
+# the complete buckets of the last span of history, all of it when span is
+# None. returns history[lo:hi] and the bucket edges, or None without any
+def window(
+    history: np.ndarray, span: dt.timedelta | None
+) -> tuple[int, int, np.ndarray] | None:
+    times = history["query_time"]
+    width = window_width(times, span)
+    # ends where the bucket in progress begins, so the window only changes
+    # once a bucket completes
+    end = floor_time(times[-1], width)
+    start = floor_time(times[0], width)
+    if span is not None:
+        start = max(start, end - np.timedelta64(span).astype("m8[us]"))
+    lo = np.searchsorted(times, start, side="left")
+    hi = np.searchsorted(times, end, side="left")
+    if hi - lo < 2:
+        return None
+    edges = start + np.arange((end - start) // width + 1) * width
+    return lo, hi, edges
+
+
+# first, lowest, highest and last entry of each bucket, and the recharges
+# reindexed into them
+def downsample(
+    history: np.ndarray, recharges: np.ndarray, edges: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+    n = len(history)
+    starts = np.concatenate(
+        [[0], np.searchsorted(history["query_time"], edges), recharges["index"] + 1]
+    )
+    starts = np.unique(starts[starts < n])
+    ends = np.append(starts[1:], n)
+
+    # sorted by bucket, then by value, each bucket begins with its lowest entry
+    buckets = np.repeat(np.arange(len(starts)), ends - starts)
+    order = np.lexsort((history["remain"], buckets))
+    keep = np.unique(np.concatenate([starts, ends - 1, order[starts], order[ends - 1]]))
+
+    kept_recharges = recharges.copy()
+    kept_recharges["index"] = np.searchsorted(keep, recharges["index"])
+    return history[keep], kept_recharges
+
+
+# power between each pair of entries of decharged history in watts, the peak
+# of those starting in each bucket
+def pair_peak(history_decharged: np.ndarray, edges: np.ndarray) -> np.ndarray:
+    x = history_decharged["query_time"].astype(np.int64)
+    y = history_decharged["remain"]
+    edge_x = edges.astype(np.int64)
+    watts = -np.diff(y) / (np.diff(x) / 1e6) * 3.6e6
+    bucket = np.searchsorted(edge_x, x[:-1], side="right") - 1
+    inside = (bucket >= 0) & (bucket < len(edges) - 1) & np.isfinite(watts)
+    peak = np.zeros(len(edges) - 1)
+    np.maximum.at(peak, bucket[inside], watts[inside])
+    return peak
+
+
+# average and peak power of each bucket in watts, from decharged history.
+# finer holds the starts and peaks of finer buckets the history was
+# downsampled from, whose pairs of entries it no longer has
+def bucket_power(
+    history_decharged: np.ndarray,
+    edges: np.ndarray,
+    finer: tuple[np.ndarray, np.ndarray] | None = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    x = history_decharged["query_time"].astype(np.int64)
+    y = history_decharged["remain"]
+    edge_x = edges.astype(np.int64)
+    values = np.interp(edge_x, x, y, left=y[0], right=y[-1])
+    mean = -np.diff(values) / (np.diff(edge_x) / 1e6) * 3.6e6
+
+    peak = pair_peak(history_decharged, edges)
+    if finer is not None:
+        starts, finer_peak = finer
+        bucket = np.searchsorted(edge_x, starts.astype(np.int64), side="right") - 1
+        inside = (bucket >= 0) & (bucket < len(mean))
+        np.maximum.at(peak, bucket[inside], finer_peak[inside])
+    return mean, np.maximum(peak, mean)
@@ -0,0 +1,155 @@
+# timings and counters of a run, written as json when it ends
+#
+# spans time a stage, counters add up bytes and rows. both belong to the room
+# being worked on in the current thread, if any, or to the whole run. with
+# profiling on, the spans marked hot also run under cProfile.
+
+import json, time, threading, contextlib
+import datetime as dt
+
+default_filename = "metrics.json"
+profile_filename = "profile.prof"
+
+# stage or counter -> value, for the run and for each room
+_run: dict = {"stages": {}, "counters": {}}
+_rooms: dict[str, dict] = {}
+_lock = threading.Lock()
+_local = threading.local()
+_began = time.perf_counter()
+_profiler = None
+_profile_depth = 0
+_profiled = False  # whether any hot span ran under the profiler
+
+
+def _target() -> dict:
+    room = getattr(_local, "room", None)
+    if room is None:
+        return _run
+    if room not in _rooms:
+        _rooms[room] = {"stages": {}, "counters": {}}
+    return _rooms[room]
+
+
+# work done in this thread belongs to a room until the block ends
+@contextlib.contextmanager
+def room(name: str):
+    previous = getattr(_local, "room", None)
+    _local.room = name
+    try:
+        yield
+    finally:
+        _local.room = previous
+
+
+def add(counter: str, value: int):
+    with _lock:
+        counters = _target()["counters"]
+        counters[counter] = counters.get(counter, 0) + value
+
+
+@contextlib.contextmanager
+def span(name: str, hot: bool = False):
+    profiling = (
+        hot
+        and _profiler is not None
+        and threading.current_thread() is threading.main_thread()
+    )
+    if profiling:
+        _enable_profiler()
+    begin = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = (time.perf_counter() - begin) * 1e3
+        if profiling:
+            _disable_profiler()
+        record(name, elapsed)
+
+
+# time spent on a stage measured elsewhere, such as across many small steps
+def record(name: str, ms: float, count: int = 1):
+    with _lock:
+        stages = _target()["stages"]
+        stage = stages.setdefault(name, {"count": 0, "ms": 0.0})
+        stage["count"] += count
+        stage["ms"] += ms
+
+
+# the stages and counters gathered so far, which start over, for handing to
+# another process
+def take() -> dict:
+    global _run, _rooms
+    with _lock:
+        taken = {"run": _run, "rooms": _rooms}
+        _run = {"stages": {}, "counters": {}}
+        _rooms = {}
+    return taken
+
+
+# add what another process took to this one
+def merge(taken: dict):
+    with _lock:
+        pairs = [(_run, taken["run"])]
+        for name, source in taken["rooms"].items():
+            pairs.append((_rooms.setdefault(name, {"stages": {}, "counters": {}}), source))
+        for target, source in pairs:
+            for name, stage in source["stages"].items():
+                merged = target["stages"].setdefault(name, {"count": 0, "ms": 0.0})
+                merged["count"] += stage["count"]
+                merged["ms"] += stage["ms"]
+            for counter, value in source["counters"].items():
+                target["counters"][counter] = target["counters"].get(counter, 0) + value
+
+
+# cProfile only sees the thread it is enabled in, hot spans of other threads
+# are timed but not profiled
+def enable_profiling():
+    global _profiler
+    import cProfile
+
+    _profiler = cProfile.Profile()
+
+
+def _enable_profiler():
+    global _profile_depth, _profiled
+    if _profile_depth == 0:
+        _profiler.enable()
+        _profiled = True
+    _profile_depth += 1
+
+
+def _disable_profiler():
+    global _profile_depth
+    _profile_depth -= 1
+    if _profile_depth == 0:
+        _profiler.disable()
+
+
+def snapshot() -> dict:
+    def rounded(target: dict) -> dict:
+        stages = {
+            name: {"count": stage["count"], "ms": round(stage["ms"], 3)}
+            for name, stage in target["stages"].items()
+        }
+        return {"stages": stages, "counters": dict(target["counters"])}
+
+    with _lock:
+        return {
+            "date": dt.datetime.now().isoformat(),
+            "total_ms": round((time.perf_counter() - _began) * 1e3, 3),
+            "run": rounded(_run),
+            "rooms": {name: rounded(target) for name, target in _rooms.items()},
+        }
+
+
+def write(filename: str = default_filename):
+    with open(filename, "wt", encoding="utf-8") as f:
+        json.dump(snapshot(), f, ensure_ascii=False, indent=2)
+    print(f"metrics written to {filename}")
+    if _profiled:
+        import pstats
+
+        _profiler.dump_stats(profile_filename)
+        stats = pstats.Stats(_profiler)
+        stats.sort_stats("cumulative").print_stats(20)
+        print(f"profile written to {profile_filename}")
@@ -1,170 +1,105 @@
-import datetime as dt
-import numpy as np, matplotlib.pyplot as plt
-from scipy.interpolate import interp1d
+import os, io, json, hashlib, datetime as dt
+import numpy as np
 import matplotlib.dates as mdates
-from storage import csv_storage
+from matplotlib.figure import Figure
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from storage import csv_storage, PARTITION_MAGIC
+from records import read_records, as_history, record_dtype, load_manifest, from_us
+from rollup import rollup
+from analytics import seconds, decharge
+from forecast import forecaster, band_z
+import analytics, lod, metrics
 
 # configs
 warning_timedelta = dt.timedelta(days=3)
 recent_timedelta = dt.timedelta(days=7)
-estimate_timedelta = dt.timedelta(days=1)
+max_forecast = dt.timedelta(days=365 * 10)  # anything later is low usage
+# long-range charts, name -> (range, None for all of it, and title)
+long_ranges = {
+    "30d": (dt.timedelta(days=30), "Last 30 Days"),
+    "semester": (dt.timedelta(weeks=20), "Last 20 Weeks"),
+    "all": (None, "All Time"),
+}
+max_annotated_recharges = 30  # more would cover a long-range chart in labels
 
 
-# reads csv and returns history
-def read_csv(cs: csv_storage):
-    history: list[tuple[float, dt.datetime, dt.datetime]] = []
-    for rows in filter(lambda x:x, cs.read().split("\n")):
-        rows = rows.split(",")
-        remain, query_time, request_time = [col.strip() for col in rows]
-        remain = float(remain)
-        query_time = dt.datetime.fromisoformat(query_time)
-        request_time = dt.datetime.fromisoformat(request_time)
-        history.append((remain, query_time, request_time))
-
-    return history
+# reads history records and returns history
+def read_csv(cs: csv_storage) -> np.ndarray:
+    return as_history(read_records(cs))
 
 
 # filter out entries within recent_timedelta
-def filter_recent(
-    history: list[tuple[float, dt.datetime, dt.datetime]]
-) -> list[tuple[float, dt.datetime, dt.datetime]]:
-    first_idx = 0
-    last_datetime = history[-1][1]
-    for _, datetime, _ in history:
-        if last_datetime - datetime < recent_timedelta:
-            break
-        first_idx += 1
+def filter_recent(history: np.ndarray) -> np.ndarray:
+    query_times = history["query_time"]
+    cutoff = query_times[-1] - np.timedelta64(recent_timedelta)
+    # query times are ascending, first entry later than the cutoff
+    first_idx = np.searchsorted(query_times, cutoff, side="right")
     return history[first_idx:]
 
 
-# subtract recharges from remaining, letting values go negtive
-def decharge(history: list[tuple[float, dt.datetime, dt.datetime]]):
-    def find_smallest_greater(arr, val):
-        arr = np.asarray(arr)
-        greater_than_val = arr[arr > val]
-        if greater_than_val.size == 0:
-            return None
-        return greater_than_val.min()
-
-    recharge_values = [25, 50, 75, 100, 150, 200]
-    last_value = history[0][0]
-    recharges: list[tuple[float, int]] = []
-    recharged_sum = 0  # to be subtracted from values
-    decharged: list[tuple[float, dt.datetime, dt.datetime]] = [
-        history[0]
-    ]  # history with recharged values removed, values can be below zero
-    for i, (value, query_time, request_time) in enumerate(history[1:]):
-        if value > last_value:
-            # recharge occurs
-            delta = value - last_value
-            recharged = find_smallest_greater(recharge_values, delta)
-            if not recharged:
-                recharged = delta
-            #assert (
-            #    recharged
-            #), "amount of recharge more than the maximum value of 200 within sample interval"
-            # todo: handle cases when the amount is less than a minimum of 25
-            recharged_sum += recharged
-            recharges.append((recharged, i))
-            # print(f"recharged by {recharged}(delta:{delta}) between {last_query} and {query_time}")
-        decharged_value = value - recharged_sum
-        decharged.append((decharged_value, query_time, request_time))
-        last_value = value
-    # return decharged, recharges
-    # test
-    # print("\n".join(map(str, decharged)))
-    for recharged, idx in recharges:
-        before = history[idx]
-        after = history[idx + 1]
-        delta = after[0] - before[0]
-        before_time = before[1]
-        after_time = after[1]
-        print(
-            f"recharged by {recharged}(delta:{delta}) between {before_time} and {after_time}"
-        )
-
-    return decharged, recharges
-
+def print_costs(rollups: dict[str, np.ndarray]):
+    days = rollups["day"][-recent_timedelta.days :]
+    for cost, date in zip(days["used"], days["start"].astype("datetime64[D]")):
+        print(f"{cost} kWh spent on {date}")
 
-# costs of each day
-def get_cost(history_decharged: list[tuple[float, dt.datetime, dt.datetime]]):
-    costs: list[tuple[float, dt.date]] = []
-    # complete first and last day
 
-    # interop
-    x = [x[1].timestamp() for x in history_decharged]
-    y = [x[0] for x in history_decharged]
-    interop_f = interp1d(
-        x, y, kind="linear", bounds_error=False, fill_value=(y[0], y[-1])
-    )
-    start_date = history_decharged[0][1].date()
-    end_date = history_decharged[-1][1].date() + dt.timedelta(days=1)
-    duration_days = (end_date - start_date).days
-    for i in range(duration_days):
-        date = start_date + dt.timedelta(days=i)
-        before_ts = dt.datetime.combine(date, dt.time()).timestamp()
-        after_ts = dt.datetime.combine(
-            start_date + dt.timedelta(days=i + 1), dt.time()
-        ).timestamp()
-        before_val = interop_f(before_ts)
-        after_val = interop_f(after_ts)
-        costs.append((before_val - after_val, date))
-    # return costs
-    # test
-    for cost, date in costs:
-        print(f"{cost} kWh spent on {date}")
+# costs of each hour, day and week, printing the recent days
+def get_cost(history_decharged: np.ndarray) -> dict[str, np.ndarray]:
+    rollups = rollup(history_decharged)
+    print_costs(rollups)
+    return rollups
 
 
 # plot history diagram with recharge events annotated
 def plot_history(
-    history: list[tuple[float, dt.datetime, dt.datetime]],
-    recharges: list[tuple[float, int]],
+    ax: Axes, history: np.ndarray, recharges: np.ndarray, annotate: bool = True
 ):
-    # make extended_history
-    recharge_dict = dict(map(lambda vi: (vi[1], vi[0]), recharges))
-
-    extended_history: list[tuple[float, dt.datetime, dt.datetime]] = []
-
-    for i, (val, query_time, request_time) in enumerate(history):
-        extended_history.append((val, query_time, request_time))
-        if i in recharge_dict.keys():
-            before = history[i]
-            after = history[i + 1]
-            mid_val = (before[0] + after[0]) / 2
-            mid_time = before[1] + (after[1] - before[1]) / 2
-            recharge_val = recharge_dict[i]
-            extended_history.append((mid_val - recharge_val / 2, mid_time, None))
-            extended_history.append((mid_val + recharge_val / 2, mid_time, None))
-
-    def plot_segment(history_segment: list[tuple[float, dt.datetime, dt.datetime]]):
-        values = [item[0] for item in history_segment]
-        dates = [item[1] for item in history_segment]
-        plt.plot(
-            dates,
-            values,
+    values = history["remain"]
+    times = history["query_time"]
+    before = recharges["index"]
+    after = before + 1
+
+    # a vertical bar between each recharged pair of entries
+    mid_vals = (values[before] + values[after]) / 2
+    mid_times = times[before] + (times[after] - times[before]) / 2
+    bar_bottoms = mid_vals - recharges["amount"] / 2
+    bar_tops = mid_vals + recharges["amount"] / 2
+
+    # every bar, then every segment, as a single line broken by NaT, so the
+    # number of recharges costs nothing once drawn
+    nat = np.full(len(recharges), np.datetime64("NaT"), dtype=times.dtype)
+    nan = np.full(len(recharges), np.nan)
+
+    def plot_segments(segment_times: np.ndarray, segment_values: np.ndarray):
+        ax.plot(
+            segment_times,
+            segment_values,
             # marker="o",
             linestyle="-",
             color="b",
             label="Remaining Amount",
         )
 
-    def plot_recharge(extended_history: list[tuple[float, dt.datetime, dt.datetime]]):
-        vbars = list(filter(lambda vqr: vqr[2] is None, extended_history))
-        assert len(vbars) % 2 == 0
-        for before, after in zip(vbars[0::2], vbars[1::2]):
-            plt.plot(
-                [before[1], after[1]],  # x-axis
-                [before[0], after[0]],  # y-axis
+    def plot_recharge():
+        if len(recharges):
+            ax.plot(
+                np.column_stack([mid_times, mid_times, nat]).ravel(),  # x-axis
+                np.column_stack([bar_bottoms, bar_tops, nan]).ravel(),  # y-axis
                 linestyle="-",
                 color="orange",
                 label="Recharge",
             )
-
+        if not annotate:
+            return
+        for bar_time, bottom, top, amount in zip(
+            mid_times, bar_bottoms, bar_tops, recharges["amount"]
+        ):
             # 在垂直条的中间位置添加充电量的注释
-            plt.text(
-                before[1],  # before[1] == after[1]
-                (after[0] + before[0]) / 2,
-                f"+{after[0] - before[0]} kWh",
+            ax.text(
+                bar_time,
+                (top + bottom) / 2,
+                f"+{amount} kWh",
                 color="red",
                 fontsize=10,
                 ha="right",
@@ -172,95 +107,76 @@ def plot_history(
                 rotation="vertical",
             )
 
-    # split extended_history into segments
-
-    values = np.array(list(map(lambda x: x[0], extended_history)))
-    lshift = values[1:]
-    rcrop = values[:-1]
-    diff = rcrop - lshift
-    # recharges_count = np.count_nonzero(recharges_event)
-    begin_idx = 0
+    plot_recharge()
 
-    plot_recharge(extended_history)
-    
-    for i in (
-        np.where(diff < 0)[0] if recharges else []
-    ):  # np.where returns [[]] when condition is never satisfied, and [i] fails
-        i += 1  # offset 1 from differentiation
-        plot_segment(extended_history[begin_idx:i])
-        begin_idx = i
+    # insert the bottom and top of each bar into history, then break it into
+    # segments between recharges, each ending at a bottom and starting at a top
+    positions = np.repeat(after, 2)
+    extended_times = np.insert(times, positions, np.repeat(mid_times, 2))
+    extended_values = np.insert(
+        values, positions, np.column_stack([bar_bottoms, bar_tops]).ravel()
+    )
+    tops = after + 2 * np.arange(len(after)) + 1
+    plot_segments(
+        np.insert(extended_times, tops, nat), np.insert(extended_values, tops, nan)
+    )
 
-    plot_segment(extended_history[begin_idx:])
 
+# estimate when exhaustion occurs from the forecast of analytics, the band is
+# when it would occur at the highest and lowest likely rate
+def estimate_exhaustion(fc: forecaster, history_last: np.void) -> dict | None:
+    tlast = history_last["query_time"].item()
+    remain = float(history_last["remain"])
 
-# plot an arrow to when the estimated exhaustion occurs with text description
-def plot_exhaustion(
-    history_decharged: list[tuple[float, dt.datetime, dt.datetime]],
-    history_last: tuple[float, dt.datetime, dt.datetime],
-):
-    tlast = history_last[1]
-    for i, (v, tq, tr) in enumerate(history_decharged):
-        if tlast - tq < estimate_timedelta:
-            break
-    history_decharged = history_decharged[i:]
-
-    # 分离出电量值和时间戳
-    values = np.array([item[0] for item in history_decharged])
-    timestamps = np.array([item[1].timestamp() for item in history_decharged])
-
-    # linear fit
-    slope, intercept = np.polyfit(timestamps, values, 1)  # k, b
-
-    # calculate offset
-    y_est = slope * history_last[1].timestamp() + intercept
-    y_actual = history_last[0]
-    y_offset = y_actual - y_est
-    intercept += y_offset
-
-    # y=kx+b
-    # y=0 => kx=-b => x=-b/k
-    exhaustion_x = -intercept / slope
-    exhaustion_y = 0.0
-
-    ts_overflow = dt.datetime(3000, 1, 1, 0, 0, 0).timestamp() # 32503651200.0
-    if slope == 0.0 or abs(exhaustion_x) > ts_overflow:
+    estimate = fc.exhaustion(remain)
+    if estimate is None or estimate[0] > max_forecast.total_seconds():
         print("low electricity usage")
         return None
-        exhaustion_x = history_last[1] + warning_timedelta
-        exhaustion_y = slope * exhaustion_x.timestamp() + intercept
-        plt.text(
-            exhaustion_x,
-            exhaustion_y + 10,
-            f"no exhaustion\nuntil year 3000",
-            fontsize=10,
-            ha="center",
-        )
-        return None
-    print(f"slope={slope}, exhaustion={exhaustion_x}")
-
-    begin_x = timestamps[-1]
-    begin_y = slope * begin_x + intercept
-    begin_x = dt.datetime.fromtimestamp(begin_x)
+    seconds_left, earliest, latest = estimate
+    rate, stderr = fc.rate()
+    print(f"rate={rate * 3.6e6:.1f}W (±{band_z * stderr * 3.6e6:.1f}W), exhaustion in {seconds_left:.0f}s")
 
-    # 将时间戳转换为datetime对象
-    exhaustion_x = dt.datetime.fromtimestamp(exhaustion_x)
+    exhaustion_x = tlast + dt.timedelta(seconds=seconds_left)
+    exhaustion_y = 0.0
+    band = tuple(
+        tlast + dt.timedelta(seconds=min(s, max_forecast.total_seconds()))
+        for s in (earliest, latest)
+    )
     print(f"exhaustion_x = {exhaustion_x}")
 
     # time of exhausation threshold = 3 days
-    if (exhaustion_x - history_last[1]) >= warning_timedelta:
-        exhaustion_x = history_last[1] + warning_timedelta
-        exhaustion_y = slope * exhaustion_x.timestamp() + intercept
-        plt.text(
+    if (exhaustion_x - tlast) >= warning_timedelta:
+        exhaustion_x = tlast + warning_timedelta
+        exhaustion_y = remain - rate * warning_timedelta.total_seconds()
+        text = f"no exhaustion\nwithin {warning_timedelta.days} days"
+        warning = False
+    else:
+        time_diff = exhaustion_x - dt.datetime.now()
+        text = f"estimated exhaustion at\n{str(exhaustion_x).split('.')[0]}\nor {str(time_diff).split('.')[0]} later"
+        warning = True
+    return {
+        "begin": (tlast, remain),
+        "end": (exhaustion_x, exhaustion_y),
+        "band": band,
+        "text": text,
+        "warning": warning,
+    }
+
+
+# plot an arrow to when the estimated exhaustion occurs with text description
+def plot_exhaustion(ax: Axes, exhaustion: dict):
+    (begin_x, begin_y), (exhaustion_x, exhaustion_y) = exhaustion["begin"], exhaustion["end"]
+    if not exhaustion["warning"]:
+        ax.text(
             exhaustion_x,
             exhaustion_y + 10,
-            f"no exhaustion\nwithin {warning_timedelta.days} days",
+            exhaustion["text"],
             fontsize=10,
             ha="center",
         )
     else:
-        time_diff = exhaustion_x - dt.datetime.now()
-        plt.annotate(
-            f"estimated exhaustion at\n{str(exhaustion_x).split('.')[0]}\nor {str(time_diff).split('.')[0]} later",
+        ax.annotate(
+            exhaustion["text"],
             xy=(exhaustion_x, exhaustion_y),  # 箭头指向的位置
             xytext=(exhaustion_x, exhaustion_y + 10),  # 箭头起始位置
             arrowprops=dict(facecolor="red", shrink=0.05, headwidth=10, width=2),
@@ -268,27 +184,158 @@ def plot_exhaustion(
             ha="center",
         )
 
+    # band of likely exhaustion times, while exhaustion is within sight
+    if exhaustion["warning"]:
+        earliest, latest = exhaustion["band"]
+        ax.fill(
+            [begin_x, earliest, latest],
+            [begin_y, 0.0, 0.0],
+            color="gray",
+            alpha=0.2,
+            label="Exhaustion Band",
+        )
+
     # 绘制延长虚线
-    plt.plot(
+    ax.plot(
         [begin_x, exhaustion_x],
         [begin_y, exhaustion_y],
         linestyle="--",
         color="gray",
         label="Estimated Exhaustion",
     )
-    return exhaustion_x
 
 
-def plot_watts(history_decharged: list[tuple[float, dt.datetime, dt.datetime]]):
-    timestamps = np.array([x[1] for x in history_decharged])
-    widths = timestamps[1:] - timestamps[:-1]
-    timestamps = timestamps[:-1]
-    values = np.array([x[0] for x in history_decharged])
-    diffs = values[:-1] - values[1:]
-    watts = diffs / [x.total_seconds() for x in widths] * 3.6e6
-    plt.bar(timestamps, watts, width=widths, align="edge", color="skyblue")
+def plot_watts(ax: Axes, history_decharged: np.ndarray):
+    timestamps = seconds(history_decharged["query_time"])
+    widths = np.diff(timestamps)
+    diffs = -np.diff(history_decharged["remain"])
+    watts = diffs / widths * 3.6e6
+    ax.bar(
+        mdates.date2num(history_decharged["query_time"][:-1]),
+        watts,
+        width=widths / 86400,  # in days
+        align="edge",
+        color="skyblue",
+    )
+
+# average power of each bucket as bars, and the peak within it as steps
+def plot_power(ax: Axes, edges: np.ndarray, mean: np.ndarray, peak: np.ndarray):
+    x = mdates.date2num(edges)
+    ax.bar(x[:-1], mean, width=np.diff(x), align="edge", color="skyblue", label="Average")
+    ax.stairs(peak, x, color="orange", label="Peak")
+    ax.legend(loc="upper left")
+
+
+# downsampled history and power of the complete buckets of a long range
+def long_range_chart(
+    history: np.ndarray,
+    span: dt.timedelta | None,
+    finer: tuple[np.ndarray, np.ndarray] | None = None,
+) -> dict | None:
+    w = lod.window(history, span)
+    if w is None:
+        return None
+    lo, hi, edges = w
+    _, recharges = decharge(history[lo:hi], verbose=False)
+    lod_history, lod_recharges = lod.downsample(history[lo:hi], recharges, edges)
+    # one more entry on either side, for the power at the edges
+    around, _ = decharge(history[max(lo - 1, 0) : hi + 1], verbose=False)
+    mean, peak = lod.bucket_power(around, edges, finer)
+    return {
+        "history": lod_history,
+        "recharges": lod_recharges,
+        "edges": edges,
+        "mean": mean,
+        "peak": peak,
+    }
+
+
+# entries of a sealed partition downsampled at lod.cached_width, with the
+# start and peak power of each of those buckets. built once, a sealed
+# partition does not change
+def sealed_lod(cs: csv_storage, p: dict) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    sidecar = f"{p['name']}.lod"
+    content = cs.read_sidecar(sidecar)
+    if content is not None:
+        with np.load(io.BytesIO(content)) as saved:
+            if int(saved["rows"]) == p["rows"]:
+                return saved["history"], saved["starts"], saved["peak"]
+    history = as_history(np.frombuffer(cs.read_partition(p["name"]), dtype=record_dtype))
+    width = lod.cached_width.astype("m8[us]")
+    times = history["query_time"]
+    first = lod.floor_time(times[0], width)
+    edges = first + np.arange((times[-1] - first) // width + 2) * width
+    decharged, recharges = decharge(history, verbose=False)
+    kept, _ = lod.downsample(history, recharges, edges)
+    peak = lod.pair_peak(decharged, edges)
+    buffer = io.BytesIO()
+    np.savez(buffer, rows=len(history), history=kept, starts=edges[:-1], peak=peak)
+    cs.write_sidecar(sidecar, buffer.getvalue())
+    return kept, edges[:-1], peak
+
+
+# history of long ranges drawn in buckets of lod.cached_width or wider: the
+# sealed partitions as sealed_lod keeps them, then the records of the others.
+# with the starts and peaks of the buckets the sealed ones were kept at
+def long_range_history(
+    cs: csv_storage,
+) -> tuple[np.ndarray, tuple[np.ndarray, np.ndarray] | None]:
+    histories, starts, peaks = [], [], []
+    since = None
+    if cs.magic() == PARTITION_MAGIC:
+        for p in load_manifest(cs)[:-1]:
+            if not p["sealed"]:
+                break
+            history, p_starts, p_peak = sealed_lod(cs, p)
+            histories.append(history)
+            starts.append(p_starts)
+            peaks.append(p_peak)
+            since = from_us(p["last"] + 1)
+    histories.append(as_history(read_records(cs, since=since)))
+    finer = (np.concatenate(starts), np.concatenate(peaks)) if starts else None
+    return np.concatenate(histories), finer
+
+
+# figures kept across rooms and runs, created on first use
+figures: dict[str, tuple[Figure, Axes]] = {}
+
+render_sidecar = "render"
+
+
+# a cleared axes to draw a chart on
+def chart_axes(name: str, title: str, ylabel: str) -> Axes:
+    if name not in figures:
+        fig = Figure(figsize=(10, 6))
+        FigureCanvasAgg(fig)
+        figures[name] = (fig, fig.add_subplot())
+    fig, ax = figures[name]
+    ax.clear()
+    ax.set_title(title)
+    ax.set_xlabel("Date")
+    ax.set_ylabel(ylabel)
+    return ax
+
+
+def save_chart(name: str, filename: str):
+    fig, ax = figures[name]
+    # auto format x-axis date
+    ax.xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d %H:%M"))
+    fig.autofmt_xdate()
+    # we don't have a display to show the plot in github actions
+    with metrics.span("render", hot=True):
+        fig.savefig(filename, format="png")
+
+
+# hash of everything a chart shows, to skip charts that would come out the same
+def content_hash(*parts) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.tobytes() if isinstance(part, np.ndarray) else repr(part).encode())
+        h.update(b"\0")
+    return h.hexdigest()
 
-def plot(cs: csv_storage):
+
+def plot(cs: csv_storage) -> analytics.analytics_state:
     # history = [
     #     (10.0, dt.datetime(2024, 8, 8, 0, 0, 0), dt.datetime(2024, 8, 8, 23, 59, 59)),
     #     (8.0, dt.datetime(2024, 8, 9, 0, 0, 0), dt.datetime(2024, 8, 9, 23, 59, 59)),
@@ -300,41 +347,99 @@ def plot(cs: csv_storage):
     #     (16, dt.datetime(2024, 8, 15, 0, 0, 0), dt.datetime(2024, 8, 13, 23, 59, 59)),
     #     (11, dt.datetime(2024, 8, 16, 0, 0, 0), dt.datetime(2024, 8, 13, 23, 59, 59)),
     # ]
-    history = read_csv(cs)
-    history = filter_recent(history)
+    # fold only the entries appended since the last run into the saved state
+    state = analytics.update(cs)
+    print_costs(state.rollups)
+
+    # only the records the charts show are read
+    last_time = state.last["query_time"].item()
+    history = filter_recent(
+        as_history(read_records(cs, since=last_time - recent_timedelta))
+    )
+    # long ranges drawn in buckets of lod.cached_width or wider come from the
+    # sealed partitions kept downsampled, so a run reads the latest records
+    # only. the others from the records of the widest of them, with a bucket
+    # to spare for its alignment
+    coarse_history, finer = long_range_history(cs)
+    widths = {
+        name: lod.window_width(coarse_history["query_time"], span)
+        for name, (span, _) in long_ranges.items()
+    }
+    spans = [
+        span for name, (span, _) in long_ranges.items() if widths[name] < lod.cached_width
+    ]
+    if spans:
+        since = None if None in spans else last_time - max(spans) - lod.ladder[-1].item()
+        full_history = as_history(read_records(cs, since=since))
     decharged, recharges = decharge(history)
-    costs = get_cost(decharged)
-
-    plt.figure(1, figsize=(10, 6))
-    exhaust_time = plot_exhaustion(decharged, history[-1])
-    plot_history(history, recharges)
+    exhaustion = estimate_exhaustion(state.forecast, state.last)
+    exhaust_time = exhaustion["end"][0] if exhaustion else None
     print(f"estimate time of exhaustion: {exhaust_time}")
 
-    plt.title("History of Remaining Amount Over Time")
-    plt.xlabel("Date")
-    plt.ylabel("Remaining Amount (kWh)")
-
-    # auto format x-axis date
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d %H:%M"))
-    plt.gcf().autofmt_xdate()
-
-    # plt.legend()
-
-    # plt.show() # we don't have a display to show the plot in github actions
-    plt.savefig(f"{cs.filepath}/recent.png", format="png")
-    # delete figure
-    plt.clf()
+    saved = cs.read_sidecar(render_sidecar)
+    hashes: dict[str, str] = json.loads(saved) if saved else {}
+    charts = {
+        # the text of a warning counts down from now, the estimate it tells of
+        # is what the chart changes with
+        "recent.png": content_hash(
+            history,
+            recharges,
+            exhaustion and {k: v for k, v in exhaustion.items() if k != "text"},
+        ),
+        "watts.png": content_hash(decharged),
+    }
+    # long ranges only change once a bucket completes
+    long_range: dict[str, dict] = {}
+    for name, (span, _) in long_ranges.items():
+        with metrics.span("downsample"):
+            if widths[name] < lod.cached_width:
+                chart = long_range_chart(full_history, span)
+            else:
+                chart = long_range_chart(coarse_history, span, finer)
+        if chart is None:
+            continue
+        long_range[name] = chart
+        charts[f"history_{name}.png"] = content_hash(chart["history"], chart["recharges"])
+        charts[f"power_{name}.png"] = content_hash(
+            chart["edges"], chart["mean"], chart["peak"]
+        )
+    changed = [
+        name
+        for name, h in charts.items()
+        if hashes.get(name) != h or not os.path.exists(f"{cs.filepath}/{name}")
+    ]
+    if not changed:
+        print("charts unchanged")
+        return state
+
+    if "recent.png" in changed:
+        ax = chart_axes(
+            "recent", "History of Remaining Amount Over Time", "Remaining Amount (kWh)"
+        )
+        if exhaustion:
+            plot_exhaustion(ax, exhaustion)
+        plot_history(ax, history, recharges)
+        save_chart("recent", f"{cs.filepath}/recent.png")
 
     # plot watts
-    plt.figure(2, figsize=(10, 6))
-    plot_watts(decharged)
-    plt.title("History of Power Consumption")
-    plt.xlabel("Date")
-    plt.ylabel("Power(W)")
-
-    # auto format x-axis date
-    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter("%Y-%m-%d %H:%M"))
-    plt.gcf().autofmt_xdate()
-    plt.savefig(f"{cs.filepath}/watts.png", format="png")
-    # delete figure
-    plt.clf()
+    if "watts.png" in changed:
+        ax = chart_axes("watts", "History of Power Consumption", "Power(W)")
+        plot_watts(ax, decharged)
+        save_chart("watts", f"{cs.filepath}/watts.png")
+
+    for name, chart in long_range.items():
+        title = long_ranges[name][1]
+        if f"history_{name}.png" in changed:
+            ax = chart_axes(
+                "recent", f"Remaining Amount, {title}", "Remaining Amount (kWh)"
+            )
+            annotate = len(chart["recharges"]) <= max_annotated_recharges
+            plot_history(ax, chart["history"], chart["recharges"], annotate)
+            save_chart("recent", f"{cs.filepath}/history_{name}.png")
+        if f"power_{name}.png" in changed:
+            ax = chart_axes("watts", f"Power Consumption, {title}", "Power(W)")
+            plot_power(ax, chart["edges"], chart["mean"], chart["peak"])
+            save_chart("watts", f"{cs.filepath}/power_{name}.png")
+
+    cs.write_sidecar(render_sidecar, json.dumps(charts).encode())
+    return state
@@ -0,0 +1,93 @@
+# saving and rendering of fetched rooms, spread over processes
+#
+# rooms are saved and rendered independently of each other, so once every
+# room is fetched they are handed to a pool of worker processes. the output of
+# each room is captured in its worker and printed in the order of the rooms,
+# and the metrics of each room are merged back into this process.
+
+import os, io, sys, contextlib
+from datetime import datetime
+from itertools import repeat
+import metrics
+
+default_workers = 1
+
+
+def save_result(room_name: str, data: dict, passphrase: str):
+    # storage, numpy and matplotlib are only loaded once there is a result
+    from storage import csv_storage
+
+    remain = data["surplus"] + data["freeEnd"]  # 剩余电量 + 剩余赠送电量
+    time = datetime.fromisoformat(data["time"])
+
+    cs = csv_storage(room_name, passphrase)
+    # the meter is read less often than it is polled, a reading seen already
+    # leaves the log and the charts as they are
+    if cs.is_last_reading(remain, time):
+        metrics.add("unchanged", 1)
+        print(f"no new reading for {os.path.basename(cs.filepath)}, skipped")
+        return None
+
+    from records import append_record
+    import plot
+
+    # append query result to history
+    # timed under the storage name, room names are secret
+    with metrics.room(os.path.basename(cs.filepath)), metrics.span("save", hot=True):
+        append_record(cs, remain, time, datetime.now())
+        cs.save_last_reading(remain, time)
+
+        print(f"successfully saved to {cs.filename}")
+        return plot.plot(cs)
+
+
+# the error a room failed to save with, None once saved. one room that cannot
+# be saved loses its sample only
+def save_guarded(room_name: str, data: dict, passphrase: str) -> str | None:
+    try:
+        save_result(room_name, data, passphrase)
+    except Exception as e:
+        error = f"save failed, {type(e).__name__}: {e}"
+        print(error)
+        return error
+    return None
+
+
+# a room saved in a worker, with what it printed to stdout and stderr and the
+# metrics it took
+def save_captured(
+    room_name: str, data: dict, passphrase: str
+) -> tuple[str, str, str | None, dict]:
+    output, warnings = io.StringIO(), io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(warnings):
+        error = save_guarded(room_name, data, passphrase)
+    return output.getvalue(), warnings.getvalue(), error, metrics.take()
+
+
+# save each fetched room, (room_name, data), in order, returning the error of
+# each as save_guarded does. one worker saves them in this process
+def save_all(
+    results: list[tuple[str, dict]], passphrase: str, workers: int = default_workers
+) -> list[str | None]:
+    if workers <= 1 or len(results) <= 1:
+        return [save_guarded(room_name, data, passphrase) for room_name, data in results]
+    # imported here, multiprocessing is only needed by more than one worker
+    from concurrent.futures import ProcessPoolExecutor
+
+    names = [room_name for room_name, _ in results]
+    datas = [data for _, data in results]
+    errors = []
+    # workers forked from this process start with its metrics, dropped first
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(results)), initializer=metrics.take
+    ) as executor:
+        # map yields in the order of the rooms, each as soon as it and those
+        # before it are done
+        for output, warnings, error, taken in executor.map(
+            save_captured, names, datas, repeat(passphrase)
+        ):
+            print(output, end="", flush=True)
+            print(warnings, end="", file=sys.stderr, flush=True)
+            metrics.merge(taken)
+            errors.append(error)
+    return errors
@@ -1,46 +1,11 @@
-import requests, os, json, sys
-from datetime import datetime, timedelta
-from storage import csv_storage
-import plot
+import sys, atexit
+from room_index import room_index, bad_query
+import fetch, transport, metrics, postprocess
 from urllib.parse import parse_qs
 
 
-class bad_query(Exception):
-    # subclass but acts exactly as the base class
-    pass
-
-
-class verbose_dict(dict):
-    def __getitem__(self, key):
-        try:
-            res = super().__getitem__(key)
-            if isinstance(res, dict) and not isinstance(res, verbose_dict):
-                return verbose_dict(res)
-            return res
-        except KeyError:
-            available_keys: list[str] = list(self.keys())
-            available_keys = list(  # filter out reserved keys
-                filter(
-                    lambda s: not s.startswith("__") and not s.endswith("__"),
-                    available_keys,
-                )
-            )
-            raise bad_query(
-                f"attribute '{key}' not found. available: {sorted(available_keys)}"
-            )
-
-
-def json_or_exit(res):
-    try:
-        return res.json()
-    except Exception as e:
-        print(f"error fetching json: {e}")
-        print(f"url: {res.url}")
-        print(f"responce: {res.content}")
-        exit(1)
-
-
-def do_query(query_str: str, passphrase: str, cookies: dict):
+# validate a query string, returns room name and the search form of the api
+def parse_query(query_str: str) -> tuple[str, dict]:
     # check if such room exists
     query_name = query_str.split("@")
     if len(query_name) != 2:
@@ -56,62 +21,167 @@ def do_query(query_str: str, passphrase: str, cookies: dict):
         show_help_exit()
     campus, partment, floor, room = cpfr
     try:
-        room_id = dormitory_info[campus][partment]["floors"][floor][room]
+        partment_id, room_id = dormitory_info.room(campus, partment, floor, room)
     except bad_query as e:
         print(f"bad query: {e}")
         exit(1)
 
-    # query the api
-    print(f"querying ...", end="", flush=True)
-    responce = requests.post(
-        "https://app.bupt.edu.cn/buptdf/wap/default/search",
-        data={
-            "partmentId": dormitory_info[campus][partment]["id"],
-            "floorId": floor,
-            "dromNumber": room_id,
-            "areaid": str(int(campus != "西土城") + 1),
-        },
-        cookies=cookies,
-    )
-    print(f" done")
-
-    res: dict = json_or_exit(responce)
-
-    data = res["d"]["data"]
-    remain = data["surplus"] + data["freeEnd"]  # 剩余电量 + 剩余赠送电量
-    time = datetime.fromisoformat(data["time"])
-
-    # append query result to csv
-    cs = csv_storage(room_name, passphrase)
-    cs.append(f"{remain}, {time}, {datetime.now()}\n")
-
-    print(f"successfully saved to {cs.filename}")
-    plot.plot(cs)
+    return room_name, fetch.search_form(campus, partment_id, floor, room_id)
 
 
 def show_help_exit():
-    print("usage: query.py <query_str>[,query_str2,...] <passphrase> <cookies>")
+    print(
+        "usage: query.py [--concurrency=N] [--transport=live|record|replay] [--api-url=URL] [--timeout=S] [--recordings=DIR] <query_str>[,query_str2,...] <passphrase> <cookies>"
+    )
+    print(
+        "       query.py --sweep [--batch=N] [options] <selector> <passphrase> <cookies>"
+    )
     print(
         "example: query.py 西土城.学五楼.3.5-312-节能蓝天@学五-312宿舍,沙河.沙河校区雁北园A楼.1层.A楼102@沙河A102宿舍 example_passphrase UUkey=xxx&eai-sess=yyy"
     )
+    print(
+        f"  --concurrency=N  rooms fetched in parallel, default {fetch.default_concurrency}"
+    )
+    print("  --transport      live (default), record responses, or replay recorded ones")
+    print(f"  --api-url=URL    api to query, default {fetch.API_URL}")
+    print(f"  --timeout=S      seconds each request may take, default {fetch.default_timeout}")
+    print(f"  --recordings=DIR where responses are recorded, default {transport.default_recordings}")
+    print("  --sweep          poll every room a selector such as 西土城.学五楼.* matches")
+    print("  --batch=N        rooms of a sweep fetched and saved at once, default 500")
+    print("  --daemon         keep polling, each room as often as its forecast needs")
+    print(
+        f"  --min-interval=M minutes between polls of a room in daemon mode, at least, default {fetch.default_min_interval // 60}"
+    )
+    print(f"  --max-interval=M and at most, default {fetch.default_max_interval // 60}")
+    print(f"  --metrics=FILE   where timings of the run are written, default {metrics.default_filename}")
+    print(f"  --profile        also profile saving and rendering into {metrics.profile_filename}")
+    print(
+        f"  --workers=N      processes saving and rendering rooms, default {postprocess.default_workers}, profiled with 1 only"
+    )
     exit(1)
 
 
 # main logic
 
-if len(sys.argv) != 4:
+args, options = fetch.parse_options(sys.argv[1:])
+if len(args) != 3 or not set(options) <= {
+    "concurrency",
+    "transport",
+    "api-url",
+    "recordings",
+    "timeout",
+    "sweep",
+    "batch",
+    "metrics",
+    "profile",
+    "daemon",
+    "min-interval",
+    "max-interval",
+    "workers",
+}:
     print("invalid arguments.")
     show_help_exit()
+concurrency = options.get("concurrency", str(fetch.default_concurrency))
+if not concurrency.isdigit() or int(concurrency) < 1:
+    print("invalid concurrency")
+    show_help_exit()
+concurrency = int(concurrency)
+if options.get("transport", "live") not in transport.transport_modes:
+    print("invalid transport")
+    show_help_exit()
+try:
+    if float(options.get("timeout", fetch.default_timeout)) <= 0:
+        raise ValueError
+except ValueError:
+    print("invalid timeout")
+    show_help_exit()
+
+min_interval = options.get("min-interval", str(fetch.default_min_interval // 60))
+max_interval = options.get("max-interval", str(fetch.default_max_interval // 60))
+if (
+    not min_interval.isdigit()
+    or not max_interval.isdigit()
+    or not 0 < int(min_interval) <= int(max_interval)
+):
+    print("invalid polling interval")
+    show_help_exit()
+workers = options.get("workers", str(postprocess.default_workers))
+if not workers.isdigit() or int(workers) < 1:
+    print("invalid workers")
+    show_help_exit()
+workers = int(workers)
+if "daemon" in options and "sweep" in options:
+    print("--daemon and --sweep cannot be combined")
+    show_help_exit()
+
+if "profile" in options:
+    metrics.enable_profiling()
+# written however the run ends
+atexit.register(metrics.write, options.get("metrics", metrics.default_filename))
+
+# dormitory info index, opened on the first lookup
+dormitory_info = room_index()
+
+passphrase = args[1]
 
-# load dormitory info
-print(f"loading dormitory info ...", end="", flush=True)
-with open("dormitory_info.json", "rt", encoding="utf-8") as f:
-    dormitory_info: dict = verbose_dict(json.load(f))
+cookies = {k: v[0] for k, v in parse_qs(args[2]).items()}
+
+if "sweep" in options:
+    # imported here, numpy is only needed by sweeps
+    import sweep
+
+    batch = options.get("batch", str(sweep.default_batch))
+    if not batch.isdigit() or int(batch) < 1:
+        print("invalid batch")
+        show_help_exit()
+    t = transport.make_transport(options, cookies, concurrency)
+    try:
+        sweep.run(dormitory_info, args[0], passphrase, t, concurrency, int(batch))
+    except bad_query as e:
+        print(f"bad selector: {e}")
+        exit(1)
+    exit(0)
+
+with metrics.span("index"):
+    rooms = [parse_query(qs) for qs in args[0].split(",")]
+
+if "daemon" in options:
+    # imported here, asyncio is only needed by the daemon
+    import daemon
+
+    t = transport.make_transport(options, cookies, concurrency)
+    daemon.run(
+        rooms,
+        passphrase,
+        t,
+        lambda room_name, data: postprocess.save_result(room_name, data, passphrase),
+        concurrency,
+        int(min_interval) * 60,
+        int(max_interval) * 60,
+    )
+    exit(0)
+
+# fetch every room first, over one pooled session
+print(f"querying {len(rooms)} rooms ...", end="", flush=True)
+t = transport.make_transport(options, cookies, concurrency)
+with metrics.span("fetch"):
+    statuses = fetch.fetch_all(
+        t, [search_data for _, search_data in rooms], concurrency
+    )
 print(f" done")
 
-passphrase = sys.argv[2]
+# a room that failed to fetch or to save loses this sample only
+fetched = [i for i, status in enumerate(statuses) if status["data"] is not None]
+errors = postprocess.save_all(
+    [(rooms[i][0], statuses[i]["data"]) for i in fetched], passphrase, workers
+)
+for i, error in zip(fetched, errors):
+    if error is not None:
+        statuses[i] = {"data": None, "error": error}
 
-cookies = {k: v[0] for k, v in parse_qs(sys.argv[3]).items()}
+# room names are secret, logs of the run are not
+from storage import storage_name
 
-for qs in sys.argv[1].split(","):
-    do_query(qs, passphrase, cookies)
+fetch.print_summary([storage_name(name, passphrase) for name, _ in rooms], statuses)
+if all(status["data"] is None for status in statuses):
+    exit(1)
@@ -0,0 +1,297 @@
+# fixed-width binary history records, with a converter and csv export
+#
+# records are kept in monthly partitions next to the log, see partition(). a
+# month is sealed once a later month begins, compacted into a single frame, and
+# its file never changes again after that, so the logs branch only ever stores
+# the current month anew. an encrypted manifest lists the time range and row
+# count of each partition, so reading a window of history decrypts only the
+# partitions overlapping it.
+
+import sys, json, hmac, hashlib, datetime as dt
+import numpy as np
+from storage import csv_storage, storage_exception, LOG_MAGIC, PARTITION_MAGIC
+import metrics
+
+# one history row: remaining kWh, meter reading time and request time.
+# times are int64 microseconds since 1970-01-01 in local wall-clock time,
+# the same naive datetimes the text rows used to hold
+record_dtype = np.dtype(
+    [("remain", "<f8"), ("query_time", "<i8"), ("request_time", "<i8")]
+)
+
+# the same records with datetime64 time columns, the history type every plot.py
+# stage works on. it shares the memory layout of record_dtype
+history_dtype = np.dtype(
+    [("remain", "<f8"), ("query_time", "<M8[us]"), ("request_time", "<M8[us]")]
+)
+
+EPOCH = dt.datetime(1970, 1, 1)
+MICROSECOND = dt.timedelta(microseconds=1)
+
+
+def to_us(t: dt.datetime) -> int:
+    if t.tzinfo is not None:
+        t = t.astimezone().replace(tzinfo=None)
+    return (t - EPOCH) // MICROSECOND
+
+
+def from_us(us: int) -> dt.datetime:
+    return EPOCH + int(us) * MICROSECOND
+
+
+def pack_record(remain: float, query_time: dt.datetime, request_time: dt.datetime):
+    record = np.array(
+        [(remain, to_us(query_time), to_us(request_time))], dtype=record_dtype
+    )
+    return record.tobytes()
+
+
+# parse rows of "remain, query_time, request_time" as written by the text log
+def parse_text(content: str) -> np.ndarray:
+    rows = []
+    for row in filter(lambda x: x, content.split("\n")):
+        remain, query_time, request_time = [col.strip() for col in row.split(",")]
+        rows.append(
+            (
+                float(remain),
+                to_us(dt.datetime.fromisoformat(query_time)),
+                to_us(dt.datetime.fromisoformat(request_time)),
+            )
+        )
+    return np.array(rows, dtype=record_dtype)
+
+
+def export_csv(records: np.ndarray) -> str:
+    return "".join(
+        f"{remain}, {from_us(query_time)}, {from_us(request_time)}\n"
+        for remain, query_time, request_time in records.tolist()
+    )
+
+
+def as_history(records: np.ndarray) -> np.ndarray:
+    return records.view(history_dtype)
+
+
+manifest_sidecar = "manifest"
+MANIFEST_VERSION = 1
+
+
+# month of each record, as "YYYY-MM"
+def months(records: np.ndarray) -> np.ndarray:
+    return records["query_time"].view("<M8[us]").astype("<M8[M]").astype(str)
+
+
+# file name of a month's partition, which does not tell the month
+def partition_name(cs: csv_storage, month: str) -> str:
+    return hmac.new(cs.ensure_key(), month.encode(), hashlib.sha256).hexdigest()[:20]
+
+
+# partitions in time order, each with its month, name, the first and last
+# query time in it (microseconds), its row count and whether it is sealed
+def load_manifest(cs: csv_storage) -> list[dict]:
+    content = cs.read_sidecar(manifest_sidecar)
+    if content is None:
+        raise storage_exception(f"{cs.filepath} has partitions but no manifest")
+    return json.loads(content)["partitions"]
+
+
+def save_manifest(cs: csv_storage, partitions: list[dict]):
+    content = json.dumps({"version": MANIFEST_VERSION, "partitions": partitions})
+    cs.write_sidecar(manifest_sidecar, content.encode())
+
+
+# the last write of a partition, its frames joined into one so later reads
+# decrypt a month at once. rows are counted again, those of a torn frame are
+# counted in the manifest but were never stored
+def seal(cs: csv_storage, p: dict):
+    content = cs.read_partition(p["name"])
+    cs.write_partition(p["name"], content)
+    p["rows"] = len(content) // record_dtype.itemsize
+    p["sealed"] = True
+
+
+# add records to the partitions of their months, a month that was sealed
+# already takes no more, its records go to the latest partition instead
+def add_to_partitions(cs: csv_storage, partitions: list[dict], records: np.ndarray):
+    record_months = months(records)
+    for month in np.unique(record_months):
+        group = records[record_months == month]
+        if not partitions or month > partitions[-1]["month"]:
+            for p in partitions:
+                if not p["sealed"]:
+                    seal(cs, p)
+            partitions.append(
+                {
+                    "month": str(month),
+                    "name": partition_name(cs, str(month)),
+                    "first": int(group["query_time"].min()),
+                    "last": int(group["query_time"].max()),
+                    "rows": 0,
+                    "sealed": False,
+                }
+            )
+        target = next(
+            (p for p in partitions if p["month"] == month and not p["sealed"]),
+            partitions[-1],
+        )
+        cs.append_partition(target["name"], group.tobytes())
+        target["first"] = min(target["first"], int(group["query_time"].min()))
+        target["last"] = max(target["last"], int(group["query_time"].max()))
+        target["rows"] += len(group)
+
+
+# move the records of a log into monthly partitions, once
+def partition(cs: csv_storage, records: np.ndarray):
+    # partitions are only appended to, those of a move that crashed before the
+    # switch below would take every record again
+    cs.remove_partitions()
+    partitions: list[dict] = []
+    add_to_partitions(cs, partitions, records)
+    save_manifest(cs, partitions)
+    # the log keeps its key header only, switched last so a crash before it
+    # leaves the log as it was
+    cs.write_bytes(b"", PARTITION_MAGIC)
+    print(
+        f"moved {len(records)} rows of {cs.filename} into {len(partitions)} monthly partitions"
+    )
+
+
+# decrypted frames are parsed in chunks of about this size
+chunk_bytes = 1 << 16
+
+
+# frames joined into chunks of whole records
+def record_chunks(frames):
+    pending: list[bytes] = []
+    size = 0
+    for frame in frames:
+        pending.append(frame)
+        size += len(frame)
+        if size >= chunk_bytes:
+            yield np.frombuffer(b"".join(pending), dtype=record_dtype)
+            pending, size = [], 0
+    if pending:
+        yield np.frombuffer(b"".join(pending), dtype=record_dtype)
+
+
+# records with query times within [since, until), in the order they were
+# stored, a chunk at a time. only the partitions overlapping the range are
+# decrypted, and a partition is left as soon as its records reach until
+def iter_records(
+    cs: csv_storage, since: dt.datetime | None = None, until: dt.datetime | None = None
+):
+    since_us = to_us(since) if since is not None else None
+    until_us = to_us(until) if until is not None else None
+
+    def within(chunk: np.ndarray) -> np.ndarray:
+        query_times = chunk["query_time"]
+        mask = np.ones(len(chunk), dtype=bool)
+        if since_us is not None:
+            mask &= query_times >= since_us
+        if until_us is not None:
+            mask &= query_times < until_us
+        metrics.add("rows", int(mask.sum()))
+        return chunk if mask.all() else chunk[mask]
+
+    magic = cs.magic()
+    if magic == PARTITION_MAGIC:
+        partitions = load_manifest(cs)
+        for i, p in enumerate(partitions):
+            latest = i + 1 == len(partitions)
+            # the latest partition is always read, a crash may have left
+            # records in it the manifest does not know about yet. a frame it
+            # left torn is skipped, and cut off by the next append before it
+            # writes, see storage.append_frame
+            if not latest and (
+                (since_us is not None and p["last"] < since_us)
+                or (until_us is not None and p["first"] >= until_us)
+            ):
+                continue
+            for chunk in record_chunks(cs.iter_partition(p["name"])):
+                yield within(chunk)
+                # records within a month are stored in time order
+                if not latest and until_us is not None and chunk["query_time"][-1] >= until_us:
+                    break
+    else:
+        # text log not converted yet
+        content = cs.read()
+        with metrics.span("parse"):
+            records = parse_text(content)
+        yield within(records)
+
+
+# records with query times within [since, until), in the order they were stored
+def read_records(
+    cs: csv_storage, since: dt.datetime | None = None, until: dt.datetime | None = None
+) -> np.ndarray:
+    chunks = list(iter_records(cs, since, until))
+    if not chunks:
+        return np.empty(0, dtype=record_dtype)
+    return np.concatenate(chunks) if len(chunks) > 1 else chunks[0]
+
+
+# rewrite a text log, or the legacy single blob, as monthly partitions of
+# binary records
+def convert(cs: csv_storage) -> np.ndarray:
+    if cs.magic() != LOG_MAGIC:
+        # a key header first, partitions are sealed with its key. the rows
+        # stay text until the switch to partitions
+        cs.write_bytes(cs.read_bytes(), LOG_MAGIC)
+    with metrics.span("parse"):
+        records = parse_text(cs.read())
+    partition(cs, records)
+    return records
+
+
+def append_records(cs: csv_storage, records: np.ndarray):
+    magic = cs.magic()
+    if magic is None:
+        # a new log, its key header comes first
+        cs.write_bytes(b"", PARTITION_MAGIC)
+        partitions = []
+    else:
+        if magic != PARTITION_MAGIC:
+            convert(cs)
+        partitions = load_manifest(cs)
+    add_to_partitions(cs, partitions, records)
+    save_manifest(cs, partitions)
+
+
+def append_record(
+    cs: csv_storage, remain: float, query_time: dt.datetime, request_time: dt.datetime
+):
+    record = np.frombuffer(pack_record(remain, query_time, request_time), record_dtype)
+    append_records(cs, record)
+
+
+def show_help_exit():
+    print("usage: records.py convert <room_name> <passphrase>")
+    print("       records.py export <room_name> <passphrase> [output.csv]")
+    exit(1)
+
+
+# main logic
+
+if __name__ == "__main__":
+    if len(sys.argv) not in (4, 5) or sys.argv[1] not in ("convert", "export"):
+        print("invalid arguments.")
+        show_help_exit()
+
+    command, room_name, passphrase = sys.argv[1:4]
+    cs = csv_storage(room_name, passphrase)
+    try:
+        if command == "convert":
+            if cs.magic() == PARTITION_MAGIC:
+                print(f"{cs.filename} already holds monthly partitions")
+            else:
+                convert(cs)
+        else:
+            content = export_csv(read_records(cs))
+            if len(sys.argv) == 5:
+                with open(sys.argv[4], "wt", encoding="utf-8") as f:
+                    f.write(content)
+            else:
+                print(content, end="")
+    except storage_exception as e:
+        print(f"storage error: {e}")
+        exit(1)
@@ -0,0 +1,145 @@
+# energy used per hour, day and week, rolled up from decharged history
+
+import io
+import numpy as np
+from storage import csv_storage
+from records import partition_name
+
+# length and alignment of each rollup period, weeks start on monday
+periods = {
+    "hour": (np.timedelta64(1, "h"), np.datetime64("1970-01-01", "us")),
+    "day": (np.timedelta64(1, "D"), np.datetime64("1970-01-01", "us")),
+    "week": (np.timedelta64(7, "D"), np.datetime64("1970-01-05", "us")),
+}
+
+# energy used within [start, start + period)
+rollup_dtype = np.dtype([("start", "<M8[us]"), ("used", "<f8")])
+
+# the week table and the months saved, hour and day tables are saved a month
+# at a time so a run rewrites only the months it changed
+rollups_sidecar = "rollups"
+monthly_periods = ("hour", "day")
+
+
+# bin boundaries of a period covering first..last
+def bin_edges(first: np.datetime64, last: np.datetime64, period: str) -> np.ndarray:
+    length, origin = periods[period]
+    length = length.astype("m8[us]")
+    first_bin = (first - origin) // length
+    last_bin = (last - origin) // length
+    return origin + np.arange(first_bin, last_bin + 2) * length
+
+
+def rollup(history_decharged: np.ndarray) -> dict[str, np.ndarray]:
+    query_times = history_decharged["query_time"]
+    edges = {
+        period: bin_edges(query_times[0], query_times[-1], period)
+        for period in periods
+    }
+
+    # one interpolation over the edges of every period, values outside the
+    # history are held at the first and last entry
+    x = query_times.astype(np.int64)
+    y = history_decharged["remain"]
+    all_edges = np.concatenate(list(edges.values()))
+    all_values = np.interp(all_edges.astype(np.int64), x, y, left=y[0], right=y[-1])
+
+    rollups: dict[str, np.ndarray] = {}
+    offset = 0
+    for period, period_edges in edges.items():
+        values = all_values[offset : offset + len(period_edges)]
+        offset += len(period_edges)
+        table = np.empty(len(period_edges) - 1, dtype=rollup_dtype)
+        table["start"] = period_edges[:-1]
+        table["used"] = -np.diff(values)
+        rollups[period] = table
+    return rollups
+
+
+# add rollups of a later stretch of history, sharing at most the bins around
+# where the stretches meet
+def merge_rollups(
+    rollups: dict[str, np.ndarray], later: dict[str, np.ndarray]
+) -> dict[str, np.ndarray]:
+    merged: dict[str, np.ndarray] = {}
+    for period in periods:
+        table, later_table = rollups[period], later[period]
+        if len(table) == 0 or len(later_table) == 0:
+            merged[period] = table if len(later_table) == 0 else later_table.copy()
+            continue
+        first_idx = np.searchsorted(table["start"], later_table["start"][0])
+        shared = min(len(table) - first_idx, len(later_table))
+        table = np.concatenate([table, later_table[shared:]])
+        table["used"][first_idx : first_idx + shared] += later_table["used"][:shared]
+        merged[period] = table
+    return merged
+
+
+# month of each bin, as "YYYY-MM"
+def bin_months(table: np.ndarray) -> np.ndarray:
+    return table["start"].astype("<M8[M]").astype(str)
+
+
+# like partitions, the name of a month's rollups does not tell the month
+def month_sidecar(cs: csv_storage, month: str) -> str:
+    return f"{partition_name(cs, month)}.rollups"
+
+
+# save the months from that of since on, all of them when since is None.
+# months before it are those of bins no entry after since falls in
+def save_rollups(
+    cs: csv_storage, rollups: dict[str, np.ndarray], since: np.datetime64 | None = None
+):
+    months = {period: bin_months(rollups[period]) for period in monthly_periods}
+    written = np.unique(np.concatenate(list(months.values())))
+    saved = []
+    if since is not None:
+        written = written[written >= str(since.astype("<M8[M]"))]
+        index = read_index(cs)
+        if index is not None:
+            saved = [month for month in index["months"].tolist() if month < written[0]]
+    for month in written.tolist():
+        buffer = io.BytesIO()
+        np.savez(
+            buffer,
+            **{period: rollups[period][months[period] == month] for period in monthly_periods},
+        )
+        cs.write_sidecar(month_sidecar(cs, month), buffer.getvalue())
+    buffer = io.BytesIO()
+    np.savez(buffer, week=rollups["week"], months=np.array(saved + written.tolist()))
+    cs.write_sidecar(rollups_sidecar, buffer.getvalue())
+
+
+def read_index(cs: csv_storage) -> dict[str, np.ndarray] | None:
+    content = cs.read_sidecar(rollups_sidecar)
+    if content is None:
+        return None
+    with np.load(io.BytesIO(content)) as saved:
+        return {name: saved[name] for name in ("week", "months")}
+
+
+# hour and day tables from the month of since on, all of them when since is
+# None, and the whole week table
+def load_rollups(
+    cs: csv_storage, since: np.datetime64 | None = None
+) -> dict[str, np.ndarray] | None:
+    index = read_index(cs)
+    if index is None:
+        return None
+    months = index["months"].tolist()
+    if since is not None:
+        months = [month for month in months if month >= str(since.astype("<M8[M]"))]
+    tables: dict[str, list[np.ndarray]] = {period: [] for period in monthly_periods}
+    for month in months:
+        content = cs.read_sidecar(month_sidecar(cs, month))
+        if content is None:
+            return None
+        with np.load(io.BytesIO(content)) as saved:
+            for period in monthly_periods:
+                tables[period].append(saved[period])
+    rollups = {
+        period: np.concatenate(tables[period]) if tables[period] else np.empty(0, rollup_dtype)
+        for period in monthly_periods
+    }
+    rollups["week"] = index["week"]
+    return rollups
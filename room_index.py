@@ -0,0 +1,152 @@
+# precompiled lookup index over dormitory_info.json
+#
+# the index is a hash table in a memory mapped file, keyed by the full
+# "campus.partment.floor.room" path and every prefix of it. resolving a room
+# reads one bucket and one entry, without parsing the whole json.
+
+import os, json, mmap, struct, hashlib
+
+info_filename = "dormitory_info.json"
+index_filename = "dormitory_info.idx"
+
+# on-disk layout of the index:
+#   INDEX_MAGIC | sha256 of the json it was built from | bucket count | entry count
+#   bucket = key hash (8 bytes, 0 for empty) + entry offset + entry length
+#   entry = json of [key, value], where value holds "id" and/or "children"
+INDEX_MAGIC = b"DMTIDX1\n"
+INDEX_HEADER = struct.Struct("<8s32sII")
+BUCKET = struct.Struct("<QII")
+
+
+class bad_query(Exception):
+    # subclass but acts exactly as the base class
+    pass
+
+
+def key_hash(key: str) -> int:
+    h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+    return h or 1  # 0 marks an empty bucket
+
+
+def source_digest(filename: str) -> bytes:
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).digest()
+
+
+def build_index(info_filename: str = info_filename, index_filename: str = index_filename):
+    with open(info_filename, "rb") as f:
+        content = f.read()
+    dormitory_info: dict = json.loads(content)
+
+    # every prefix of every room path, reserved "__*__" keys left out
+    def visible(d: dict):
+        return [k for k in d if not k.startswith("__") and not k.endswith("__")]
+
+    entries: dict[str, dict] = {"": {"children": visible(dormitory_info)}}
+    for campus in visible(dormitory_info):
+        partments = dormitory_info[campus]
+        entries[campus] = {"children": list(partments)}
+        for partment, part in partments.items():
+            path = f"{campus}.{partment}"
+            entries[path] = {"id": part["id"], "children": list(part["floors"])}
+            for floor, rooms in part["floors"].items():
+                entries[f"{path}.{floor}"] = {"children": list(rooms)}
+                for room, room_id in rooms.items():
+                    entries[f"{path}.{floor}.{room}"] = {"id": room_id}
+
+    # load factor at most 0.5, linear probing
+    bucket_count = 1 << (2 * len(entries) - 1).bit_length()
+    buckets = bytearray(BUCKET.size * bucket_count)
+    heap = bytearray()
+    heap_offset = INDEX_HEADER.size + len(buckets)
+    for key, value in entries.items():
+        entry = json.dumps([key, value], ensure_ascii=False).encode()
+        h = key_hash(key)
+        i = h % bucket_count
+        while BUCKET.unpack_from(buckets, i * BUCKET.size)[0]:
+            i = (i + 1) % bucket_count
+        BUCKET.pack_into(buckets, i * BUCKET.size, h, heap_offset + len(heap), len(entry))
+        heap += entry
+
+    header = INDEX_HEADER.pack(
+        INDEX_MAGIC, hashlib.sha256(content).digest(), bucket_count, len(entries)
+    )
+    tmp_filename = f"{index_filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        f.write(header + buckets + heap)
+    os.replace(tmp_filename, index_filename)
+
+
+class room_index(object):
+    def __init__(
+        self, info_filename: str = info_filename, index_filename: str = index_filename
+    ):
+        self.info_filename = info_filename
+        self.index_filename = index_filename
+        self.map = None  # opened on first lookup
+
+    def open(self):
+        if not self.is_fresh():
+            print(f"building {self.index_filename} ...", end="", flush=True)
+            build_index(self.info_filename, self.index_filename)
+            print(f" done")
+        with open(self.index_filename, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        _, _, self.bucket_count, _ = INDEX_HEADER.unpack_from(self.map, 0)
+
+    def is_fresh(self) -> bool:
+        if not os.path.exists(self.index_filename):
+            return False
+        with open(self.index_filename, "rb") as f:
+            header = f.read(INDEX_HEADER.size)
+        if len(header) != INDEX_HEADER.size:
+            return False
+        magic, digest, _, _ = INDEX_HEADER.unpack(header)
+        return magic == INDEX_MAGIC and digest == source_digest(self.info_filename)
+
+    # entry of a path, or None if there is no such path
+    def get(self, key: str) -> dict | None:
+        if self.map is None:
+            self.open()
+        h = key_hash(key)
+        i = h % self.bucket_count
+        while True:
+            bucket_hash, offset, length = BUCKET.unpack_from(
+                self.map, INDEX_HEADER.size + i * BUCKET.size
+            )
+            if bucket_hash == 0:
+                return None
+            if bucket_hash == h:
+                entry_key, value = json.loads(self.map[offset : offset + length])
+                if entry_key == key:
+                    return value
+            i = (i + 1) % self.bucket_count
+
+    # entry of a path given by its parts, naming the first missing part if any
+    def lookup(self, *parts: str) -> dict:
+        value = self.get(".".join(parts))
+        if value is not None:
+            return value
+        for depth in range(len(parts)):
+            parent = self.get(".".join(parts[:depth]))
+            if parts[depth] not in parent["children"]:
+                raise bad_query(
+                    f"attribute '{parts[depth]}' not found. available: {sorted(parent['children'])}"
+                )
+        raise bad_query(f"attribute '{'.'.join(parts)}' not found")
+
+    def children(self, *parts: str) -> list[str]:
+        return self.lookup(*parts).get("children", [])
+
+    # partment id and room id of a room
+    def room(self, campus: str, partment: str, floor: str, room: str):
+        partment_id = self.lookup(campus, partment)["id"]
+        room_id = self.lookup(campus, partment, floor, room)["id"]
+        return partment_id, room_id
+
+
+# main logic
+
+if __name__ == "__main__":
+    build_index()
+    print(f"built {index_filename} from {info_filename}")
@@ -0,0 +1,313 @@
+# read-only http service of room histories, answering in json
+#
+# rooms are addressed by their storage name, the directory under logs/, since
+# room names are secret:
+#   GET /rooms                            rooms the passphrase opens
+#   GET /rooms/<name>/latest              the last reading
+#   GET /rooms/<name>/recent?days=N       readings of the last N days, default 7
+#   GET /rooms/<name>/rollups?period=P    energy used each hour, day or week
+#   GET /rooms/<name>/forecast            consumption rates and exhaustion
+#
+# decrypted histories, analytics states and responses are kept in an lru
+# cache bounded in bytes. entries belong to a version of their room, taken
+# from the size and mtime of its files, and are dropped once it changes. every
+# response carries that version as its etag, so a request with a matching
+# If-None-Match is answered 304 from a stat of the room directory alone.
+
+import os, re, sys, json, hashlib, threading, traceback
+import datetime as dt
+from collections import OrderedDict
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+import numpy as np
+from storage import csv_storage, storage_exception, SWEEP_MAGIC
+from records import as_history, read_records
+from rollup import periods
+from forecast import horizons
+from fetch import parse_options
+import analytics, metrics
+
+default_port = 8080
+default_cache_mb = 64
+default_days = 7
+max_days = 366 * 10
+# files of a room the responses are computed from, charts are not
+data_suffixes = (".enc", ".part")
+
+room_pattern = re.compile(r"[0-9a-f]{40}")
+
+
+class http_error(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+# least recently used entries go first once the cache holds more than
+# max_bytes, each entry is valid for one version of its room
+class lru_cache(object):
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: OrderedDict[tuple, tuple[str, object, int]] = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key: tuple, version: str):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                metrics.add("cache_misses", 1)
+                return None
+            self.entries.move_to_end(key)
+            metrics.add("cache_hits", 1)
+            return entry[1]
+
+    def put(self, key: tuple, version: str, value, size: int):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old[2]
+            if size > self.max_bytes:
+                return
+            self.entries[key] = (version, value, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.size -= evicted
+
+    # computed once per version of a room, by fn returning (value, size)
+    def cached(self, key: tuple, version: str, fn):
+        value = self.get(key, version)
+        if value is None:
+            value, size = fn()
+            self.put(key, version, value, size)
+        return value
+
+
+# changes whenever a file the responses are computed from does
+def room_version(cs: csv_storage) -> str:
+    files = sorted(
+        (entry.name, entry.stat().st_size, entry.stat().st_mtime_ns)
+        for entry in os.scandir(cs.filepath)
+        if entry.name.endswith(data_suffixes)
+    )
+    return hashlib.sha1(repr(files).encode()).hexdigest()[:20]
+
+
+def time_strings(times: np.ndarray) -> list[str]:
+    return np.datetime_as_string(times, unit="s").tolist()
+
+
+class service(object):
+    def __init__(self, passphrase: str, cache_bytes: int):
+        self.passphrase = passphrase
+        self.cache = lru_cache(cache_bytes)
+
+    def open(self, name: str) -> csv_storage:
+        if not room_pattern.fullmatch(name):
+            raise http_error(404, "no such room")
+        try:
+            cs = csv_storage.open_existing(name, self.passphrase)
+            if cs.magic() == SWEEP_MAGIC:
+                raise storage_exception("a sweep, not a room")
+            cs.ensure_key()
+        except storage_exception:
+            # a room of another passphrase looks like no room at all
+            raise http_error(404, "no such room")
+        return cs
+
+    def rooms(self) -> list[str]:
+        names = []
+        if not os.path.isdir("logs"):
+            return names
+        for name in sorted(os.listdir("logs")):
+            try:
+                self.open(name)
+            except http_error:
+                continue
+            names.append(name)
+        return names
+
+    def state(self, cs: csv_storage, version: str) -> analytics.analytics_state:
+        def compute():
+            # brought up to date in memory, the service never writes to logs/.
+            # rollups of every month, the whole tables are served
+            state, _ = analytics.refresh(cs, verbose=False, all_rollups=True)
+            rollups_size = sum(table.nbytes for table in state.rollups.values())
+            return state, rollups_size + state.recharges.nbytes + 1024
+
+        return self.cache.cached((cs.filepath, "state"), version, compute)
+
+    def recent(self, cs: csv_storage, version: str, days: int) -> np.ndarray:
+        state = self.state(cs, version)
+
+        def compute():
+            since = state.last["query_time"].item() - dt.timedelta(days=days)
+            history = as_history(read_records(cs, since=since))
+            return history, history.nbytes
+
+        return self.cache.cached((cs.filepath, "recent", days), version, compute)
+
+    def latest(self, cs: csv_storage, version: str, query: dict) -> dict:
+        last = self.state(cs, version).last
+        return {
+            "remain": float(last["remain"]),
+            "query_time": time_strings(last["query_time"]),
+            "request_time": time_strings(last["request_time"]),
+        }
+
+    def recent_window(self, cs: csv_storage, version: str, query: dict) -> dict:
+        days = query.get("days", str(default_days))
+        if not days.isdigit() or not 0 < int(days) <= max_days:
+            raise http_error(400, "invalid days")
+        history = self.recent(cs, version, int(days))
+        return {
+            "query_time": time_strings(history["query_time"]),
+            "remain": history["remain"].tolist(),
+        }
+
+    def rollups(self, cs: csv_storage, version: str, query: dict) -> dict:
+        period = query.get("period", "day")
+        if period not in periods:
+            raise http_error(400, f"period is one of {', '.join(periods)}")
+        table = self.state(cs, version).rollups[period]
+        return {
+            "period": period,
+            "start": time_strings(table["start"]),
+            "used": table["used"].tolist(),  # kWh
+        }
+
+    def forecast(self, cs: csv_storage, version: str, query: dict) -> dict:
+        state = self.state(cs, version)
+        last_time = state.last["query_time"].item()
+        rates = {}
+        for horizon in horizons:
+            mean, stderr = state.forecast.rate(horizon)
+            rates[horizon] = {"watts": mean * 3.6e6, "stderr_watts": stderr * 3.6e6}
+        exhaustion = state.forecast.exhaustion(float(state.last["remain"]))
+        if exhaustion is not None:
+            exhaustion = {
+                name: (last_time + dt.timedelta(seconds=seconds)).isoformat(timespec="seconds")
+                if np.isfinite(seconds)
+                else None
+                for name, seconds in zip(("estimate", "earliest", "latest"), exhaustion)
+            }
+        return {
+            "remain": float(state.last["remain"]),
+            "query_time": last_time.isoformat(timespec="seconds"),
+            "rates": rates,
+            "exhaustion": exhaustion,  # None when not running out
+        }
+
+    resources = {
+        "latest": latest,
+        "recent": recent_window,
+        "rollups": rollups,
+        "forecast": forecast,
+    }
+
+    # status, etag and body of a get
+    def get(self, path: str, query: dict, if_none_match: str | None):
+        parts = path.strip("/").split("/")
+        if parts == ["rooms"]:
+            return 200, None, self.rooms()
+        if len(parts) != 3 or parts[0] != "rooms" or parts[2] not in self.resources:
+            raise http_error(404, "not found")
+        cs = self.open(parts[1])
+        version = room_version(cs)
+        resource = f"{parts[2]}?{sorted(query.items())}"
+        etag = '"' + hashlib.sha1(f"{version}/{resource}".encode()).hexdigest()[:20] + '"'
+        if if_none_match == etag:
+            metrics.add("not_modified", 1)
+            return 304, etag, None
+
+        def compute():
+            body = self.resources[parts[2]](self, cs, version, query)
+            content = json.dumps(body, ensure_ascii=False).encode()
+            return content, len(content)
+
+        return 200, etag, self.cache.cached((cs.filepath, resource), version, compute)
+
+
+def make_handler(api: service):
+    class handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            query = {k: v[0] for k, v in parse_qs(url.query).items()}
+            etag = None
+            try:
+                with metrics.span("request"):
+                    status, etag, body = api.get(
+                        url.path, query, self.headers.get("If-None-Match")
+                    )
+            except http_error as e:
+                status, body = e.status, {"error": str(e)}
+            except storage_exception as e:
+                # a room without records to answer with, or one that cannot
+                # be read. the message names its storage path only
+                status, body = 404, {"error": str(e)}
+            except Exception:
+                traceback.print_exc()
+                status, body = 500, {"error": "internal error"}
+            if body is not None and not isinstance(body, bytes):
+                body = json.dumps(body, ensure_ascii=False).encode()
+            self.send_response(status)
+            if etag is not None:
+                self.send_header("ETag", etag)
+                # dashboards ask again each time, and get a 304 while unchanged
+                self.send_header("Cache-Control", "no-cache")
+            if body is None:
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return handler
+
+
+def serve(
+    passphrase: str, port: int = default_port, cache_mb: int = default_cache_mb
+) -> ThreadingHTTPServer:
+    api = service(passphrase, cache_mb << 20)
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(api))
+    server.daemon_threads = True
+    return server
+
+
+def show_help_exit():
+    print("usage: service.py [--port=N] [--cache-mb=N] <passphrase>")
+    print(f"  --port=N      port to listen on, default {default_port}")
+    print(f"  --cache-mb=N  memory for decrypted histories and responses, default {default_cache_mb}")
+    exit(1)
+
+
+# main logic
+
+if __name__ == "__main__":
+    args, options = parse_options(sys.argv[1:])
+    if len(args) != 1 or not set(options) <= {"port", "cache-mb"}:
+        print("invalid arguments.")
+        show_help_exit()
+    port = options.get("port", str(default_port))
+    cache_mb = options.get("cache-mb", str(default_cache_mb))
+    if not port.isdigit() or not 0 < int(port) < 65536:
+        print("invalid port")
+        show_help_exit()
+    if not cache_mb.isdigit():
+        print("invalid cache size")
+        show_help_exit()
+
+    server = serve(args[0], int(port), int(cache_mb))
+    print(f"serving http://127.0.0.1:{port}/rooms")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,183 @@
+# local stand-in for the bupt electricity api, for load testing without it
+#
+# serves part, floor, drom and search from dormitory_info.json. every room has a
+# meter of its own, read every reading_interval and used at a steady rate, that
+# is recharged once it runs out. responses can be delayed and can fail, like
+# the real api does under load or with expired cookies.
+#
+# point query.py or dormitory_info.py at it with
+#   --api-url=http://127.0.0.1:8000/buptdf/wap/default
+
+import sys, json, time, random, hashlib, threading
+import datetime as dt
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import parse_qs
+from fetch import parse_options
+from dormitory_info import info_filename, campus_list
+
+API_PATH = "/buptdf/wap/default"
+
+default_port = 8000
+default_latency = 0.0  # milliseconds, on average
+default_error_rate = 0.0
+reading_interval = dt.timedelta(minutes=15)
+
+# what the api answers with once cookies expired
+login_page = b"<!DOCTYPE html><html><head><title>\xe7\x99\xbb\xe5\xbd\x95</title></head></html>"
+
+
+class meter(object):
+    def __init__(self, partment_id: str, room_id: str):
+        seed = hashlib.sha1(f"{partment_id}/{room_id}".encode()).digest()
+        rng = random.Random(seed)
+        self.capacity = rng.choice([25, 50, 75, 100, 150, 200])
+        self.rate = rng.uniform(0.05, 1.5)  # kWh per hour
+        self.free = rng.choice([0, 0, 0, 5, 10])  # 赠送电量, used last
+        self.offset = rng.uniform(0, self.capacity)
+
+    # reading of the last reading_interval before now
+    def read(self, now: dt.datetime) -> dict:
+        reading_time = now - (now - dt.datetime.min) % reading_interval
+        hours = reading_time.timestamp() / 3600
+        remain = self.capacity - (self.offset + self.rate * hours) % self.capacity
+        free_end = min(remain, self.free)
+        return {
+            "surplus": round(remain - free_end, 2),
+            "freeEnd": round(free_end, 2),
+            "time": reading_time.strftime("%Y-%m-%d %H:%M:%S"),
+        }
+
+
+class standin(object):
+    def __init__(self, info: dict, latency: float, error_rate: float):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.campuses = {area_id: info[name] for area_id, name in campus_list}
+        self.meters: dict[tuple[str, str], meter] = {}
+        self.lock = threading.Lock()
+
+    def partments(self, form: dict) -> dict:
+        campus = self.campuses.get(form.get("areaid"), {})
+        return {
+            partment["id"]: (name, partment)
+            for name, partment in campus.items()
+            if isinstance(partment, dict)
+        }
+
+    def part(self, form: dict):
+        return [
+            {"partmentId": partment_id, "partmentName": name}
+            for partment_id, (name, _) in self.partments(form).items()
+        ]
+
+    def floor(self, form: dict):
+        _, partment = self.partments(form)[form["partmentId"]]
+        return [{"floorName": floor} for floor in partment["floors"]]
+
+    def drom(self, form: dict):
+        _, partment = self.partments(form)[form["partmentId"]]
+        rooms = partment["floors"][form["floorId"]]
+        return [{"dromName": name, "dromNum": num} for name, num in rooms.items()]
+
+    def search(self, form: dict):
+        _, partment = self.partments(form)[form["partmentId"]]
+        rooms = partment["floors"][form["floorId"]]
+        if form["dromNumber"] not in rooms.values():
+            raise KeyError(form["dromNumber"])
+        key = (form["partmentId"], form["dromNumber"])
+        with self.lock:
+            if key not in self.meters:
+                self.meters[key] = meter(*key)
+        return self.meters[key].read(dt.datetime.now())
+
+    # status and body of a post to an endpoint
+    def handle(self, endpoint: str, form: dict) -> tuple[int, bytes, str]:
+        if self.latency > 0:
+            time.sleep(random.uniform(0.5, 1.5) * self.latency / 1e3)
+        if random.random() < self.error_rate:
+            if random.random() < 0.5:
+                return 502, b"", "text/plain"
+            return 200, login_page, "text/html"
+        if endpoint not in ("part", "floor", "drom", "search"):
+            return 404, b"", "text/plain"
+        try:
+            data = getattr(self, endpoint)(form)
+            res = {"e": 0, "m": "操作成功", "d": {"data": data}}
+        except KeyError:
+            res = {"e": 1, "m": "参数错误", "d": {"data": None}}
+        return 200, json.dumps(res, ensure_ascii=False).encode(), "application/json"
+
+
+def make_handler(api: standin):
+    class handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real api
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = self.rfile.read(length).decode()
+            form = {k: v[0] for k, v in parse_qs(body).items()}
+            path, _, endpoint = self.path.rpartition("/")
+            if path != API_PATH:
+                status, content, content_type = 404, b"", "text/plain"
+            else:
+                status, content, content_type = api.handle(endpoint, form)
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    return handler
+
+
+def serve(
+    port: int = default_port,
+    latency: float = default_latency,
+    error_rate: float = default_error_rate,
+    filename: str = info_filename,
+) -> ThreadingHTTPServer:
+    with open(filename, "rt", encoding="utf-8") as f:
+        info = json.load(f)
+    server = ThreadingHTTPServer(
+        ("127.0.0.1", port), make_handler(standin(info, latency, error_rate))
+    )
+    server.daemon_threads = True
+    return server
+
+
+def show_help_exit():
+    print(
+        "usage: standin.py [--port=N] [--latency=MS] [--error-rate=P] [--info=dormitory_info.json]"
+    )
+    print(f"  --port=N        port to listen on, default {default_port}")
+    print("  --latency=MS    average delay of each response in milliseconds")
+    print("  --error-rate=P  fraction of responses that fail, 0 to 1")
+    exit(1)
+
+
+# main logic
+
+if __name__ == "__main__":
+    args, options = parse_options(sys.argv[1:])
+    if args or not set(options) <= {"port", "latency", "error-rate", "info"}:
+        print("invalid arguments.")
+        show_help_exit()
+    try:
+        port = int(options.get("port", default_port))
+        latency = float(options.get("latency", default_latency))
+        error_rate = float(options.get("error-rate", default_error_rate))
+    except ValueError:
+        port, latency, error_rate = 0, -1, -1
+    if not 0 < port < 65536 or latency < 0 or not 0 <= error_rate <= 1:
+        print("invalid port, latency or error rate")
+        show_help_exit()
+
+    server = serve(port, latency, error_rate, options.get("info", info_filename))
+    print(f"serving http://127.0.0.1:{port}{API_PATH}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -1,29 +1,44 @@
-import os, hashlib, hmac
+import os, time, hashlib, hmac, struct
 from cryptography.hazmat.primitives.kdf.scrypt import Scrypt
 from cryptography.hazmat.primitives import hashes, padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
+import metrics
 
 
-def encrypt(data: bytes, passphrase: str) -> bytes:
-    salt = os.urandom(16)
+# derived keys by (passphrase, salt), so scrypt runs at most once per salt per process
+_key_cache: dict[tuple[str, bytes], bytes] = {}
+key_cache_stats = {"hits": 0, "misses": 0}
+
+
+def derive_key(passphrase: str, salt: bytes) -> bytes:
+    key = _key_cache.get((passphrase, salt))
+    if key is not None:
+        key_cache_stats["hits"] += 1
+        metrics.add("key_cache_hits", 1)
+        return key
+    key_cache_stats["misses"] += 1
+    metrics.add("key_cache_misses", 1)
     kdf = Scrypt(salt=salt, length=32, n=2**14, r=8, p=1, backend=default_backend())
-    key = kdf.derive(passphrase.encode())
+    with metrics.span("scrypt"):
+        key = kdf.derive(passphrase.encode())
+    _key_cache[(passphrase, salt)] = key
+    return key
+
+
+def encrypt_with_key(data: bytes, key: bytes) -> bytes:
     iv = os.urandom(16)
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
     encryptor = cipher.encryptor()
     padder = padding.PKCS7(algorithms.AES.block_size).padder()
     padded_data = padder.update(data) + padder.finalize()
     ciphertext = encryptor.update(padded_data) + encryptor.finalize()
-    return salt + iv + ciphertext
+    return iv + ciphertext
 
 
-def decrypt(encrypted_data: bytes, passphrase: str) -> bytes:
-    salt = encrypted_data[:16]
-    iv = encrypted_data[16:32]
-    ciphertext = encrypted_data[32:]
-    kdf = Scrypt(salt=salt, length=32, n=2**14, r=8, p=1, backend=default_backend())
-    key = kdf.derive(passphrase.encode())
+def decrypt_with_key(encrypted_data: bytes, key: bytes) -> bytes:
+    iv = encrypted_data[:16]
+    ciphertext = encrypted_data[16:]
     cipher = Cipher(algorithms.AES(key), modes.CBC(iv), backend=default_backend())
     decryptor = cipher.decryptor()
     padded_data = decryptor.update(ciphertext) + decryptor.finalize()
@@ -32,50 +47,346 @@ def decrypt(encrypted_data: bytes, passphrase: str) -> bytes:
     return data
 
 
+def decrypt(encrypted_data: bytes, passphrase: str) -> bytes:
+    salt = encrypted_data[:16]
+    key = derive_key(passphrase, salt)
+    return decrypt_with_key(encrypted_data[16:], key)
+
+
+# proves a derived key is the right one without decrypting any record
+def key_check(key: bytes) -> bytes:
+    return hmac.new(key, b"dormitricity key check", hashlib.sha256).digest()[:16]
+
+
+# decrypted frames, timed as one decrypt stage however many there are
+def timed_decrypt(frames, decrypt_frame):
+    elapsed = 0.0
+    try:
+        for frame in frames:
+            begin = time.perf_counter()
+            data = decrypt_frame(frame)
+            elapsed += time.perf_counter() - begin
+            yield data
+    finally:
+        metrics.record("decrypt", elapsed * 1e3)
+
+
 class storage_exception(Exception):
     pass
 
 
+# on-disk layout of log.enc:
+#   magic | salt (16 bytes) | key_check(key) (16 bytes) | frame | frame | ...
+#   frame = ciphertext length (4 bytes, big endian) + iv + ciphertext
+# every frame is encrypted with the store key derived once from the header salt.
+# appending only encrypts the new records and writes one frame at the end.
+# the magic tells what the frames hold:
+#   - LOG_MAGIC: text rows, see read() and append()
+#   - SWEEP_MAGIC: columns of many rooms per frame, see sweep.py
+#   - PARTITION_MAGIC: no frames, records are in monthly partitions, see
+#     records.py and the partition methods below
+# the legacy single encrypted blob, without magic, is migrated on the first
+# append
+LOG_MAGIC = b"DMTLOG2\n"
+SWEEP_MAGIC = b"DMTSWP1\n"
+PARTITION_MAGIC = b"DMTPRT1\n"
+# layouts starting with a key header
+KEYED_MAGICS = (LOG_MAGIC, SWEEP_MAGIC, PARTITION_MAGIC)
+KEY_HEADER = struct.Struct("16s16s")
+FRAME_HEADER = struct.Struct(">I")
+HEADER_SIZE = len(LOG_MAGIC) + KEY_HEADER.size
+
+
+def pack_frame(data: bytes, key: bytes) -> bytes:
+    frame = encrypt_with_key(data, key)
+    return FRAME_HEADER.pack(len(frame)) + frame
+
+
+def iter_frames(content: bytes, offset: int):
+    while offset + FRAME_HEADER.size <= len(content):
+        (length,) = FRAME_HEADER.unpack_from(content, offset)
+        offset += FRAME_HEADER.size
+        if offset + length > len(content):
+            # torn frame from an interrupted append, records in it are lost
+            print(f"warning: ignoring truncated frame at offset {offset}")
+            break
+        yield content[offset : offset + length]
+        offset += length
+
+
+# end of the last whole frame of a file, frames starting at offset. found from
+# the frame headers alone
+def frames_end(f, offset: int) -> int:
+    size = os.fstat(f.fileno()).st_size
+    while offset + FRAME_HEADER.size <= size:
+        f.seek(offset)
+        (length,) = FRAME_HEADER.unpack(f.read(FRAME_HEADER.size))
+        if offset + FRAME_HEADER.size + length > size:
+            break
+        offset += FRAME_HEADER.size + length
+    return offset
+
+
+# append a frame after the last whole one. the torn frame of an interrupted
+# append is cut off first, its length would otherwise reach into the new one
+def append_frame(filename: str, offset: int, frame: bytes):
+    with open(filename, "r+b") as f:
+        end = frames_end(f, offset)
+        if end < os.fstat(f.fileno()).st_size:
+            print(f"warning: cutting off truncated frame at offset {end} of {filename}")
+            f.truncate(end)
+        f.seek(end)
+        f.write(frame)
+
+
+# directory name of a room, which does not tell the room
+def storage_name(name: str, passphrase: str) -> str:
+    # get file name using hash
+    passphrase_bytes = passphrase.encode("utf-8")
+    input_bytes = name.encode("utf-8")
+    # generate hash using HMAC-SHA1
+    return hmac.new(passphrase_bytes, input_bytes, hashlib.sha1).hexdigest()
+
+
 class csv_storage(object):
     filepath: str
     filename: str
     passphrase: str
+    key: bytes | None  # store key, known once the header is read or written
 
     def __init__(self, name: str, passphrase: str):
         self.passphrase = passphrase
-        # get file name using hash
-        passphrase_bytes = passphrase.encode("utf-8")
-        input_bytes = name.encode("utf-8")
-        # generate hash using HMAC-SHA1
-        hmac_hash = hmac.new(passphrase_bytes, input_bytes, hashlib.sha1)
-        self.filepath = f"logs/{hmac_hash.hexdigest()}"
+        self.key = None
+        self.filepath = f"logs/{storage_name(name, passphrase)}"
         self.filename = f"{self.filepath}/log.enc"
         if not os.path.exists(self.filepath):
             os.mkdir(self.filepath)
 
-    def read(self) -> str:
+    # a store known only by its directory, such as one listed from logs/
+    @classmethod
+    def open_existing(cls, dirname: str, passphrase: str):
+        filepath = f"logs/{dirname}"
+        if not os.path.isfile(f"{filepath}/log.enc"):
+            raise storage_exception(f"no log in {filepath}")
+        cs = cls.__new__(cls)
+        cs.passphrase = passphrase
+        cs.key = None
+        cs.filepath = filepath
+        cs.filename = f"{filepath}/log.enc"
+        return cs
+
+    def load_key(self, header: bytes) -> bytes:
+        salt, check = KEY_HEADER.unpack_from(header, len(LOG_MAGIC))
+        key = derive_key(self.passphrase, salt)
+        if not hmac.compare_digest(key_check(key), check):
+            raise storage_exception(f"incorrect passphrase for {self.filename}")
+        self.key = key
+        return key
+
+    def ensure_key(self) -> bytes:
+        if self.key is None:
+            with open(self.filename, "rb") as f:
+                header = f.read(HEADER_SIZE)
+            if not header.startswith(KEYED_MAGICS):
+                raise storage_exception(f"{self.filename} has no key header yet")
+            self.load_key(header)
+        return self.key
+
+    def magic(self) -> bytes | None:
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, "rb") as f:
+            return f.read(len(LOG_MAGIC))
+
+    # decrypted frames of the log one at a time, the whole log for the legacy
+    # layout without frames
+    def iter_bytes(self):
         if not os.path.exists(self.filename):
             raise storage_exception(
                 "history file not found. probably incorrect passphrase and/or dorm_name?"
             )
-        with open(self.filename, "rb") as f:
+        with metrics.span("read"), open(self.filename, "rb") as f:
             content = f.read()
-        content = decrypt(content, self.passphrase)
-        content = content.decode()
-        return content
+        metrics.add("bytes_read", len(content))
+        if content.startswith(KEYED_MAGICS):
+            key = self.load_key(content)
+            frames = iter_frames(content, HEADER_SIZE)
+            yield from timed_decrypt(frames, lambda frame: decrypt_with_key(frame, key))
+        else:
+            yield from timed_decrypt([content], lambda frame: decrypt(frame, self.passphrase))
+
+    def read_bytes(self) -> bytes:
+        return b"".join(self.iter_bytes())
+
+    # history records within [since, until) a chunk at a time, see records.py
+    def iter_records(self, since=None, until=None):
+        # imported here, the store itself does not need numpy
+        from records import iter_records
+
+        return iter_records(self, since, until)
+
+    def read(self) -> str:
+        if self.magic() in (SWEEP_MAGIC, PARTITION_MAGIC):
+            raise storage_exception(
+                f"{self.filename} holds binary records, read it with records.read_records or sweep.read_sweeps"
+            )
+        return self.read_bytes().decode()
+
+    def write_bytes(self, content: bytes, magic: bytes):
+        if self.key is None or self.magic() not in KEYED_MAGICS:
+            salt = os.urandom(16)
+            self.key = derive_key(self.passphrase, salt)
+        else:
+            # keep the current salt so the cached key stays valid
+            with open(self.filename, "rb") as f:
+                salt, _ = KEY_HEADER.unpack(f.read(HEADER_SIZE)[len(magic) :])
+        frames = magic + KEY_HEADER.pack(salt, key_check(self.key))
+        if content:
+            with metrics.span("encrypt"):
+                frames += pack_frame(content, self.key)
+        # write to a temporary file first so a crash never leaves half a log
+        tmp_filename = f"{self.filename}.tmp"
+        with metrics.span("write"):
+            with open(tmp_filename, "wb") as f:
+                f.write(frames)
+            os.replace(tmp_filename, self.filename)
+        metrics.add("bytes_written", len(frames))
 
     def write(self, content: str):
-        content = encrypt(content.encode(), self.passphrase)
-        with open(self.filename, "wb") as f:
-            f.write(content)
+        self.write_bytes(content.encode(), LOG_MAGIC)
+
+    def append_bytes(self, content: bytes, magic: bytes):
+        if not content:
+            return
+        current = self.magic()
+        # create an empty log if not exist
+        if current is None:
+            self.write_bytes(b"", magic)
+        elif current != magic:
+            if magic != LOG_MAGIC or current in KEYED_MAGICS:
+                raise storage_exception(
+                    f"{self.filename} holds a different record format, convert it first"
+                )
+            # migrate older layouts into a framed log with a key header, once
+            self.write_bytes(self.read_bytes(), magic)
+        key = self.ensure_key()
+        with metrics.span("encrypt"):
+            frame = pack_frame(content, key)
+        with metrics.span("write"):
+            append_frame(self.filename, HEADER_SIZE, frame)
+        metrics.add("bytes_written", len(frame))
 
     def append(self, content: str):
-        # create an empty file if not exist
-        if not os.path.exists(self.filename):
-            # not really empty though
-            self.write("")
-        content = self.read() + content
-        self.write(content)
+        self.append_bytes(content.encode(), LOG_MAGIC)
+
+    # small derived files kept next to the log, sealed with the store key:
+    #   key_check(key) (16 bytes) | iv | ciphertext
+    def sidecar_filename(self, name: str) -> str:
+        return f"{self.filepath}/{name}.enc"
+
+    def write_sidecar(self, name: str, content: bytes):
+        key = self.ensure_key()
+        filename = self.sidecar_filename(name)
+        tmp_filename = f"{filename}.tmp"
+        with metrics.span("encrypt"):
+            sealed = key_check(key) + encrypt_with_key(content, key)
+        with metrics.span("write"):
+            with open(tmp_filename, "wb") as f:
+                f.write(sealed)
+            os.replace(tmp_filename, filename)
+        metrics.add("bytes_written", len(sealed))
+
+    # None if missing, or sealed with a key the log no longer uses
+    def read_sidecar(self, name: str) -> bytes | None:
+        filename = self.sidecar_filename(name)
+        if not os.path.exists(filename):
+            return None
+        key = self.ensure_key()
+        with metrics.span("read"), open(filename, "rb") as f:
+            content = f.read()
+        metrics.add("bytes_read", len(content))
+        if not hmac.compare_digest(content[:16], key_check(key)):
+            return None
+        with metrics.span("decrypt"):
+            return decrypt_with_key(content[16:], key)
+
+    # digest of the last reading appended, kept in the clear so a repeated
+    # reading is told apart without deriving the key or reading the log.
+    # keyed with the passphrase and the room, so equal readings of two rooms
+    # do not show
+    def reading_digest(self, remain: float, query_time) -> str:
+        reading = f"{os.path.basename(self.filepath)}|{remain!r}|{query_time.isoformat()}"
+        return hmac.new(
+            self.passphrase.encode("utf-8"), reading.encode("utf-8"), hashlib.sha256
+        ).hexdigest()
+
+    def last_reading_filename(self) -> str:
+        return f"{self.filepath}/last"
+
+    def is_last_reading(self, remain: float, query_time) -> bool:
+        filename = self.last_reading_filename()
+        if not os.path.exists(filename) or not os.path.exists(self.filename):
+            return False
+        with open(filename, "rt", encoding="utf-8") as f:
+            last = f.read().strip()
+        return hmac.compare_digest(last, self.reading_digest(remain, query_time))
+
+    def save_last_reading(self, remain: float, query_time):
+        filename = self.last_reading_filename()
+        tmp_filename = f"{filename}.tmp"
+        with open(tmp_filename, "wt", encoding="utf-8") as f:
+            f.write(self.reading_digest(remain, query_time) + "\n")
+        os.replace(tmp_filename, filename)
+
+    # partitions of a log kept in files of their own, sealed with the store key
+    # and only ever appended to:
+    #   key_check(key) (16 bytes) | frame | frame | ...
+    def partition_filename(self, name: str) -> str:
+        return f"{self.filepath}/{name}.part"
+
+    def write_partition(self, name: str, content: bytes):
+        key = self.ensure_key()
+        filename = self.partition_filename(name)
+        with metrics.span("encrypt"):
+            sealed = key_check(key) + pack_frame(content, key)
+        tmp_filename = f"{filename}.tmp"
+        with metrics.span("write"):
+            with open(tmp_filename, "wb") as f:
+                f.write(sealed)
+            os.replace(tmp_filename, filename)
+        metrics.add("bytes_written", len(sealed))
+
+    def append_partition(self, name: str, content: bytes):
+        filename = self.partition_filename(name)
+        if not os.path.exists(filename):
+            self.write_partition(name, content)
+            return
+        key = self.ensure_key()
+        with metrics.span("encrypt"):
+            frame = pack_frame(content, key)
+        with metrics.span("write"):
+            append_frame(filename, 16, frame)
+        metrics.add("bytes_written", len(frame))
+
+    def remove_partitions(self):
+        for filename in os.listdir(self.filepath):
+            if filename.endswith(".part"):
+                os.remove(f"{self.filepath}/{filename}")
+
+    # decrypted frames of a partition one at a time
+    def iter_partition(self, name: str):
+        filename = self.partition_filename(name)
+        key = self.ensure_key()
+        with metrics.span("read"), open(filename, "rb") as f:
+            content = f.read()
+        metrics.add("bytes_read", len(content))
+        if not hmac.compare_digest(content[:16], key_check(key)):
+            raise storage_exception(f"{filename} is sealed with another key")
+        frames = iter_frames(content, 16)
+        yield from timed_decrypt(frames, lambda frame: decrypt_with_key(frame, key))
+
+    def read_partition(self, name: str) -> bytes:
+        return b"".join(self.iter_partition(name))
 
 
 # 示例使用
@@ -90,3 +401,4 @@ if __name__ == "__main__":
     cont = c.read()
 
     print("read:", cont)
+    print("key cache:", key_cache_stats)
@@ -0,0 +1,162 @@
+# sweeps: every room matching a selector polled at once, kept in one store
+#
+# a selector is a query string whose parts may be patterns, such as
+# 西土城.学五楼.* for every room of a partment. missing parts match anything.
+#
+# a sweep store is one encrypted log with SWEEP_MAGIC instead of a directory
+# per room. each frame is a batch of one sweep, as columns:
+#   request_time (8 bytes) | count (4 bytes) | room[count] | remain[count] | query_time[count]
+# where room indexes the room table, a sidecar listing the key of every room
+# the store has seen. times are microseconds since epoch, as in records.py.
+
+import json, struct, datetime as dt
+from fnmatch import fnmatchcase
+import numpy as np
+from storage import csv_storage, SWEEP_MAGIC
+from records import to_us
+from room_index import room_index, bad_query
+import fetch, metrics
+
+default_batch = 500
+rooms_sidecar = "rooms"
+
+SWEEP_HEADER = struct.Struct("<qI")
+# one room of one sweep, as read back
+sweep_dtype = np.dtype(
+    [
+        ("request_time", "<M8[us]"),
+        ("room", "<u4"),
+        ("remain", "<f8"),
+        ("query_time", "<M8[us]"),
+    ]
+)
+
+
+# keys of the rooms a selector matches, in index order
+def expand(index: room_index, selector: str) -> list[str]:
+    patterns = selector.split(".")
+    if len(patterns) > 4:
+        raise bad_query(f"invalid selector '{selector}'")
+    patterns += ["*"] * (4 - len(patterns))
+    paths: list[list[str]] = [[]]
+    for pattern in patterns:
+        paths = [
+            path + [child]
+            for path in paths
+            for child in index.children(*path)
+            if fnmatchcase(child, pattern)
+        ]
+    return [".".join(path) for path in paths]
+
+
+# search form of the api for a room key
+def room_form(index: room_index, key: str) -> dict:
+    campus, partment, floor, room = key.split(".")
+    partment_id, room_id = index.room(campus, partment, floor, room)
+    return fetch.search_form(campus, partment_id, floor, room_id)
+
+
+def sweep_store(selector: str, passphrase: str) -> csv_storage:
+    return csv_storage(f"sweep {selector}", passphrase)
+
+
+def read_rooms(store: csv_storage) -> list[str]:
+    if store.magic() is None:
+        return []
+    content = store.read_sidecar(rooms_sidecar)
+    return json.loads(content) if content else []
+
+
+# position of each key in the room table, adding the keys it lacks
+def room_ids(store: csv_storage, keys: list[str]) -> np.ndarray:
+    rooms = read_rooms(store)
+    positions = {key: i for i, key in enumerate(rooms)}
+    added = [key for key in keys if key not in positions]
+    if added:
+        for key in added:
+            positions[key] = len(rooms)
+            rooms.append(key)
+        if store.magic() is None:
+            store.write_bytes(b"", SWEEP_MAGIC)
+        # before any frame refers to them
+        store.write_sidecar(rooms_sidecar, json.dumps(rooms, ensure_ascii=False).encode())
+    return np.array([positions[key] for key in keys], dtype="<u4")
+
+
+def pack_batch(
+    request_time: dt.datetime,
+    rooms: np.ndarray,
+    remains: np.ndarray,
+    query_times: np.ndarray,
+) -> bytes:
+    return b"".join(
+        [
+            SWEEP_HEADER.pack(to_us(request_time), len(rooms)),
+            rooms.astype("<u4").tobytes(),
+            remains.astype("<f8").tobytes(),
+            query_times.astype("<i8").tobytes(),
+        ]
+    )
+
+
+# every room of every sweep, in the order they were written
+def read_sweeps(store: csv_storage) -> np.ndarray:
+    content = store.read_bytes()
+    batches = []
+    offset = 0
+    while offset < len(content):
+        request_time, count = SWEEP_HEADER.unpack_from(content, offset)
+        offset += SWEEP_HEADER.size
+        batch = np.empty(count, dtype=sweep_dtype)
+        batch["request_time"] = np.datetime64(request_time, "us")
+        for name, dtype in (("room", "<u4"), ("remain", "<f8"), ("query_time", "<i8")):
+            column = np.frombuffer(content, dtype=dtype, count=count, offset=offset)
+            batch[name] = column.view("<M8[us]") if name == "query_time" else column
+            offset += count * np.dtype(dtype).itemsize
+        batches.append(batch)
+    return np.concatenate(batches) if batches else np.empty(0, dtype=sweep_dtype)
+
+
+# poll every room of a selector, a batch at a time, appending each batch to
+# the store as soon as it is fetched
+def run(
+    index: room_index,
+    selector: str,
+    passphrase: str,
+    transport,
+    concurrency: int = fetch.default_concurrency,
+    batch: int = default_batch,
+) -> csv_storage:
+    keys = expand(index, selector)
+    if not keys:
+        raise bad_query(f"no room matches '{selector}'")
+    store = sweep_store(selector, passphrase)
+    ids = room_ids(store, keys)
+    request_time = dt.datetime.now()
+
+    print(f"sweeping {len(keys)} rooms of {selector}")
+    all_statuses: list[dict] = []
+    for begin in range(0, len(keys), batch):
+        batch_keys = keys[begin : begin + batch]
+        forms = [room_form(index, key) for key in batch_keys]
+        with metrics.span("fetch"):
+            statuses = fetch.fetch_all(transport, forms, concurrency)
+        # rooms that failed are left out of this sweep
+        fetched = [i for i, status in enumerate(statuses) if status["data"] is not None]
+        results = [statuses[i]["data"] for i in fetched]
+        remains = np.array([d["surplus"] + d["freeEnd"] for d in results])
+        query_times = np.array(
+            [to_us(dt.datetime.fromisoformat(d["time"])) for d in results],
+            dtype=np.int64,
+        )
+        metrics.add("rows", len(fetched))
+        if fetched:
+            rooms = ids[begin : begin + batch][fetched]
+            store.append_bytes(
+                pack_batch(request_time, rooms, remains, query_times), SWEEP_MAGIC
+            )
+        all_statuses += statuses
+        print(f"{begin + len(batch_keys)}/{len(keys)} rooms done")
+    fetch.print_summary(keys, all_statuses, every_room=False)
+    print(f"successfully saved to {store.filename}")
+    return store
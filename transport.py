@@ -0,0 +1,97 @@
+# how requests reach the bupt api
+#
+#   live:   post to the api, or to a stand-in such as standin.py via api_url
+#   record: post like live and save every response to a directory
+#   replay: answer from the saved responses, without any network access
+
+import os, json, hashlib
+from fetch import API_URL, default_concurrency, default_timeout
+from fetch import fetch_exception, json_or_raise, make_session
+
+transport_modes = ("live", "record", "replay")
+default_recordings = "recordings"
+
+
+class transport_exception(Exception):
+    pass
+
+
+# file a response is saved to, the same for the same endpoint and form
+def recording_filename(directory: str, endpoint: str, data: dict) -> str:
+    form = json.dumps(data, sort_keys=True, ensure_ascii=False).encode()
+    return f"{directory}/{endpoint}-{hashlib.sha1(form).hexdigest()}.json"
+
+
+class live_transport(object):
+    def __init__(
+        self,
+        cookies: dict,
+        concurrency: int = default_concurrency,
+        api_url: str = API_URL,
+        timeout: float = default_timeout,
+    ):
+        self.session = make_session(cookies, concurrency)
+        self.api_url = api_url
+        self.timeout = timeout
+
+    # parsed json of a response, fetch_exception if there is none
+    def post(self, endpoint: str, data: dict) -> dict:
+        import requests
+
+        try:
+            responce = self.session.post(
+                f"{self.api_url}/{endpoint}", data=data, timeout=self.timeout
+            )
+        except requests.RequestException as e:
+            # timed out or the connection failed, worth another try
+            raise fetch_exception(f"{type(e).__name__}: {e}", retryable=True)
+        return json_or_raise(responce)
+
+
+class record_transport(live_transport):
+    def __init__(
+        self,
+        cookies: dict,
+        concurrency: int = default_concurrency,
+        api_url: str = API_URL,
+        timeout: float = default_timeout,
+        directory: str = default_recordings,
+    ):
+        super().__init__(cookies, concurrency, api_url, timeout)
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def post(self, endpoint: str, data: dict) -> dict:
+        res = super().post(endpoint, data)
+        filename = recording_filename(self.directory, endpoint, data)
+        with open(f"{filename}.tmp", "wt", encoding="utf-8") as f:
+            json.dump({"endpoint": endpoint, "data": data, "responce": res}, f, ensure_ascii=False)
+        os.replace(f"{filename}.tmp", filename)
+        return res
+
+
+class replay_transport(object):
+    def __init__(self, directory: str = default_recordings):
+        self.directory = directory
+
+    def post(self, endpoint: str, data: dict) -> dict:
+        filename = recording_filename(self.directory, endpoint, data)
+        if not os.path.exists(filename):
+            raise fetch_exception(f"no recorded responce for {endpoint} {data}")
+        with open(filename, "rt", encoding="utf-8") as f:
+            return json.load(f)["responce"]
+
+
+# a transport from the --transport, --api-url, --timeout and --recordings options
+def make_transport(options: dict[str, str], cookies: dict, concurrency: int):
+    mode = options.get("transport", "live")
+    api_url = options.get("api-url", API_URL)
+    timeout = float(options.get("timeout", default_timeout))
+    directory = options.get("recordings", default_recordings)
+    if mode == "live":
+        return live_transport(cookies, concurrency, api_url, timeout)
+    elif mode == "record":
+        return record_transport(cookies, concurrency, api_url, timeout, directory)
+    elif mode == "replay":
+        return replay_transport(directory)
+    raise transport_exception(f"unknown transport '{mode}', one of {transport_modes}")